@@ -4,6 +4,12 @@ import numpy as np
 import sys
 import os
 
+from virtual_device import VirtualDevice
+from layers import DirtyRects
+from text_cache import TextCache
+from profiler import Profiler
+import assets
+
 class Graphics:
     def __init__(self,device_connected,window_size=(700,500)):
         self.device_connected = device_connected
@@ -24,11 +30,13 @@ class Graphics:
 
         self.screenHaptics = pygame.Surface(self.window_size)
         # Add nice icon from https://www.flaticon.com/authors/vectors-market
-        self.icon = pygame.image.load('imgs/robot.png')
+        self.assets = assets.shared # images loaded once and converted to the window format (see assets.py)
+        self.icon = self.assets.image('imgs/robot.png')
         pygame.display.set_icon(self.icon)
 
-        # Add text on top to debugToggle the timing and forces
-        self.font = pygame.font.Font('freesansbold.ttf', 18)
+        # Add text on top to debugToggle the timing and forces, fonts are loaded once (see text_cache.py)
+        self.text_cache = TextCache()
+        self.font = self.text_cache.font(18)
 
         pygame.mouse.set_visible(True)     ##Hide cursor by default. 'm' toggles it
          
@@ -51,7 +59,7 @@ class Graphics:
         self.cOrange = (255,100,0)
         self.cYellow = (255,255,0)
         
-        self.hhandle = pygame.image.load('imgs/handle.png')
+        self.hhandle = self.assets.image('imgs/handle.png')
         
         self.haptic_width = 48
         self.haptic_height = 48
@@ -64,12 +72,22 @@ class Graphics:
         self.sim_b = 0.8 #1.5#0.8       ##Viscous of the pseudohaptic display
         
         self.window_scale = 3000 #2500 #pixels per meter
+        # Mass-spring-damper endpoint moved by sim_forces, 10 substeps per frame (see virtual_device.py)
+        self.sim_device = VirtualDevice(self.sim_k, self.sim_b, window_scale=self.window_scale)
         
         self.device_origin = (int(self.window_size[0]/2.0 + 0.038/2.0*self.window_scale),0)
 
         
         self.show_linkages = True
         self.show_debug = True
+        self.latency_text = "" # network latency statistics shown below the debug text
+        # Only the parts of the window that changed are updated, False to always flip the whole window
+        self.dirty_rects = True
+        self.dirty = DirtyRects(self.window_size)
+        # Stage times of the loop (see profiler.py), disabled until 'p' is pressed
+        self.profiler = Profiler()
+        self.profiler_lines = None # lines of the overlay rendered in profiler_texts
+        self.profiler_texts = []
 
     def convert_pos(self,*positions):
         #invert x because of screen axes
@@ -117,46 +135,28 @@ class Graphics:
                 keyups.append(event.key)
             elif event.type == pygame.KEYDOWN:
                 keydowns.append(event.key)
+            elif event.type == pygame.WINDOWEXPOSED: #the window has to be drawn again
+                self.dirty.invalidate()
 
         keypress = pygame.key.get_pressed()
         mouse_pos = pygame.mouse.get_pos()
         
         return keyups, mouse_pos, keypress, keydowns
 
-    def sim_forces(self,pE,f,pM,mouse_k=None,mouse_b=None):
+    def sim_forces(self,pE,f,pM,mouse_k=None,mouse_b=None,dt=None):
         #simulated device calculations
         if mouse_k is not None:
             self.sim_k = mouse_k
         if mouse_b is not None:
             self.sim_b = mouse_b
         if not self.device_connected:
-            pP = self.haptic.center
             #pM is where the mouse is
             #pE is where the position is pulled towards with the spring and damping factors
-            #pP is where the actual haptic position ends up as
+            #dt is the length of the frame in s, measured from the previous call if None
             diff = np.array(( pM[0]-pE[0],pM[1]-pE[1]) )
-            #diff = np.array(( pM[0]-pP[0],pM[1]-pP[1]) )
-            
-            scale = self.window_scale/1e3
-            scaled_vel_from_force = np.array(f)*scale/self.sim_b
-            vel_from_mouse_spring = (self.sim_k/self.sim_b)*diff
-            dpE = vel_from_mouse_spring - scaled_vel_from_force
-            #dpE = -dpE
-            #if diff[0]!=0:
-            #    if (diff[0]+dpE[0])/diff[0]<0:
-            #        #adding dpE has changed the sign (meaning the distance that will be moved is greater than the original displacement
-            #        #prevent the instantaneous velocity from exceeding the original displacement (doesn't make physical sense)
-            #        #basically if the force given is so high that in a single "tick" it would cause the endpoint to move back past it's original position...
-            #        #whatever thing is exerting the force should basically be considered a rigid object
-            #        dpE[0] = -diff[0]
-            #if diff[1]!=1:
-            #    if (diff[1]+dpE[1])/diff[1]<0:
-            #        dpE[1] = -diff[1]
-            if abs(dpE[0])<1:
-                dpE[0] = 0
-            if abs(dpE[1])<1:
-                dpE[1] = 0
-            pE = np.round(pE+dpE) #update new positon of the end effector
+            self.sim_device.k = self.sim_k
+            self.sim_device.b = self.sim_b
+            pE = self.sim_device.step(pE,f,pM,dt) #update new positon of the end effector (float pixels)
             
             #Change color based on effort
             cg = 255-np.clip(np.linalg.norm(self.sim_k*diff/self.window_scale)*255*20,0,255)
@@ -165,7 +165,12 @@ class Graphics:
         return pE
 
     def erase_screen(self):
-        self.screenHaptics.fill(self.cWhite) #erase the haptics surface
+        #erase what was drawn on the haptics surface in the last frame
+        if self.dirty.previous is None:
+            self.screenHaptics.fill(self.cWhite)
+        else:
+            for rect in self.dirty.previous:
+                self.screenHaptics.fill(self.cWhite, rect)
         self.debug_text = ""
     
     def render(self,pA0,pB0,pA,pB,pE,f,pM):
@@ -177,68 +182,91 @@ class Graphics:
         if self.device_connected:
             self.effort_color = (255,255,255)
 
+        # Everything drawn adds the rect it covers to the dirty rects
+        dirty = self.dirty.add
+
         #pygame.draw.rect(self.screenHaptics, self.effort_color, self.haptic,border_radius=4)
-        pygame.draw.rect(self.screenHaptics, self.effort_color, self.effort_cursor,border_radius=8)
+        dirty(pygame.draw.rect(self.screenHaptics, self.effort_color, self.effort_cursor,border_radius=8))
 
         ######### Robot visualization ###################
         if self.show_linkages:
             pantographColor = (150,150,150)
-            pygame.draw.lines(self.screenHaptics, pantographColor, False,[pA0,pA],15)
-            pygame.draw.lines(self.screenHaptics, pantographColor, False,[pB0,pB],15)
-            pygame.draw.lines(self.screenHaptics, pantographColor, False,[pA,pE],15)
-            pygame.draw.lines(self.screenHaptics, pantographColor, False,[pB,pE],15)
+            dirty(pygame.draw.lines(self.screenHaptics, pantographColor, False,[pA0,pA],15))
+            dirty(pygame.draw.lines(self.screenHaptics, pantographColor, False,[pB0,pB],15))
+            dirty(pygame.draw.lines(self.screenHaptics, pantographColor, False,[pA,pE],15))
+            dirty(pygame.draw.lines(self.screenHaptics, pantographColor, False,[pB,pE],15))
             
             for p in ( pA0,pB0,pA,pB,pE):
-                pygame.draw.circle(self.screenHaptics, (0, 0, 0),p, 15)
+                dirty(pygame.draw.circle(self.screenHaptics, (0, 0, 0),p, 15))
                 pygame.draw.circle(self.screenHaptics, (200, 200, 200),p, 6)
         
         ### Hand visualisation
-        self.screenHaptics.blit(self.hhandle,self.effort_cursor)
+        dirty(self.screenHaptics.blit(self.hhandle,self.effort_cursor))
         
         #pygame.draw.line(self.screenHaptics, (0, 0, 0), (self.haptic.center),(self.haptic.center+2*k*(xm-xh)))
         
         ###################Render the VR surface###################
         
         if not self.device_connected:
-            pygame.draw.lines(self.screenHaptics, (0,0,0), False,[self.effort_cursor.center,pM],2)
-        ##Fuse it back together
-        self.window.blit(self.screenHaptics, (0,0))
+            dirty(pygame.draw.lines(self.screenHaptics, (0,0,0), False,[self.effort_cursor.center,pM],2))
 
         ##Print status in  overlay
         if self.show_debug:    
             self.debug_text += "FPS = " + str(round(self.clock.get_fps()))+" "
             self.debug_text += "fe: ["+str(np.round(f[0],1))+","+str(np.round(f[1],1))+"] "
             self.debug_text += "xh: ["+str(np.round(pE[0],1))+","+str(np.round(pE[1],1))+"]"
-            self.text = self.font.render(self.debug_text, True, (0, 0, 0), (255, 255, 255))
-            self.window.blit(self.text, self.textRect)
+            self.text = self.font.render(self.debug_text, True, (0, 0, 0), (255, 255, 255)) # new every frame, not cached
+            dirty(self.screenHaptics.blit(self.text, self.textRect))
+            if self.latency_text:
+                latency_text = self.font.render(self.latency_text, True, (0, 0, 0), (255, 255, 255))
+                dirty(self.screenHaptics.blit(latency_text, (self.textRect.left, self.textRect.bottom + 4)))
+
+        # Stage times of the loop, 'p' toggles the profiler
+        if self.profiler.enabled:
+            self.draw_profiler(self.textRect.left, self.textRect.bottom + 30)
 
-        pygame.display.flip()    
+        ##Fuse it back together, only the dirty rects unless most of the window changed
+        with self.profiler.stage("flip"):
+            self.dirty.present(self.window, self.screenHaptics, self.dirty_rects)
         ##Slow down the loop to match FPS
-        self.clock.tick(self.FPS)
+        with self.profiler.stage("wait"):
+            self.clock.tick(self.FPS)
+
+    def draw_profiler(self, x, y):
+        # Overlay of the profiler, one line per stage. The lines only change when the profiler refreshes them, they
+        # are rendered then and not through the text cache
+        lines = self.profiler.overlay()
+        if lines is not self.profiler_lines:
+            self.profiler_lines = lines
+            font = self.text_cache.font(14)
+            self.profiler_texts = [font.render(line, True, (0, 0, 0), (255, 255, 255)) for line in lines]
+        for text in self.profiler_texts:
+            self.dirty.add(self.screenHaptics.blit(text, (x, y)))
+            y += text.get_height()
 
     def show_loading_screen(self, started = False, i=0):
         # Show Intro message
         if(not started):
             self.window.fill(self.cBlack)
             init_text = "PRESS SPACE BAR TO BEGIN"
-            init_font = pygame.font.Font('freesansbold.ttf', 30)
-            init_text = init_font.render(init_text, True, self.cGreen, self.cBlack)
+            init_text = self.text_cache.render(init_text, 30, self.cGreen, self.cBlack)
             init_text_rect = init_text.get_rect()
             init_text_rect.center = (350, 250)
             self.window.blit(init_text, init_text_rect)
             pygame.display.flip()
+            self.dirty.invalidate()
             
         else:
             if (i % 2500 == 0):
                 self.window.fill(self.cBlack)
                 dots_cycle = ["", ".", "..", "...", "....", ".....", "......", ".......","........", ".........",".........."]
                 init_text = "WAITING FOR COMMUNICATION: " + dots_cycle[((i//2500) % 11)]
-                init_font = pygame.font.Font('freesansbold.ttf', 10)
-                init_text = init_font.render(init_text, True, (0, 255, 0), (0, 0, 0))
+                init_text = self.text_cache.render(init_text, 10, (0, 255, 0), (0, 0, 0))
                 init_text_rect = init_text.get_rect()
                 init_text_rect.topleft = (100, 300)
                 self.window.blit(init_text, init_text_rect)
                 pygame.display.flip()  
+                self.dirty.invalidate()
 
     def show_exit_screen(self, passed, final_time, path_length, damage):
         # Show Exit message
@@ -250,14 +278,13 @@ class Graphics:
         else:
             title_text = "Game Over!!!"
             title_color = self.cRed
-        title_font = pygame.font.Font('freesansbold.ttf', 60)
-        title_text = title_font.render(title_text, True, title_color, (0, 0, 0))
+        title_text = self.text_cache.font(60).render(title_text, True, title_color, (0, 0, 0))
         title_text_rect = title_text.get_rect()
         title_text_rect.center = (350, 100)
         self.window.blit(title_text, title_text_rect)
 
         suma_text = f"Time: {final_time:.2f}s \n Path length {path_length:.2f} pixels \n Damage: {damage:.0f}%"
-        suma_font = pygame.font.Font('freesansbold.ttf', 30)
+        suma_font = self.text_cache.font(30)
         suma_lines = suma_text.split("\n")
         offset = 200
         for line in suma_lines:
@@ -268,8 +295,7 @@ class Graphics:
             offset += 40
 
         continue_text = f"Press SPACE BAR to play again, or any other key to quit"
-        continue_font = pygame.font.Font('freesansbold.ttf', 20)
-        continue_text = continue_font.render(continue_text, True, self.cWhite, (0, 0, 0))
+        continue_text = self.text_cache.render(continue_text, 20, self.cWhite, (0, 0, 0))
         continue_text_rect = continue_text.get_rect()
         continue_text_rect.center = (350, 400)
         self.window.blit(continue_text, continue_text_rect)
@@ -288,6 +314,7 @@ class Graphics:
                     display = False
                     play_again = False
 
+        self.dirty.invalidate()
         return play_again
 
     def close(self):
@@ -5,28 +5,41 @@ import sys
 import os
 import time 
 
+from fish import FishSwarm
+from virtual_device import VirtualDevice
+from layers import Layer, DirtyRects
+from text_cache import TextCache
+from profiler import Profiler
+import assets
+
 class Graphics:
-    def __init__(self,device_connected, num_fish=0, window_size=(800,600), max_time=1.0):
+    def __init__(self,device_connected, num_fish=0, window_size=(800,600), max_time=1.0, headless=False, clock=time.time, rng=None):
         self.device_connected = device_connected
         self.max_time = max_time
+        self.clock_time = clock # time of the simulation, for the remaining time
+        self.headless = headless # no window: only the scene state is updated, nothing is drawn
         
         # Initialize pygame window
         self.window_size = window_size #default (800, 600)
         os.environ['SDL_VIDEO_WINDOW_POS'] = "20,100" # Where in the screen the window pops up
         pygame.init()
-        self.window = pygame.display.set_mode((window_size[0], window_size[1]))
-        pygame.display.set_caption('Yellow Submarine')
+        if not headless:
+            self.window = pygame.display.set_mode((window_size[0], window_size[1]))
+            pygame.display.set_caption('Yellow Submarine')
 
         self.screenHaptics = pygame.Surface(self.window_size)
         self.xc = self.screenHaptics.get_rect().centerx
         self.yc = self.screenHaptics.get_rect().centery
 
         ##add nice icon from https://www.cleanpng.com/png-yellow-submarine-clip-art-submarine-biomass-vector-1902493/
-        self.icon = pygame.image.load('imgs/yellow_submarine_left.png')
-        pygame.display.set_icon(self.icon)
+        self.assets = assets.shared # images loaded once and converted to the window format (see assets.py)
+        self.icon = self.assets.image('imgs/yellow_submarine_left.png')
+        if not headless:
+            pygame.display.set_icon(self.icon)
 
-        ##add text on top to debugToggle the timing and forces
-        self.font = pygame.font.Font('freesansbold.ttf', 18)
+        ##add text on top to debugToggle the timing and forces, fonts and labels are loaded once (see text_cache.py)
+        self.text_cache = TextCache()
+        self.font = self.text_cache.font(18)
 
         pygame.mouse.set_visible(True)     ##Hide cursor by default. 'm' toggles it
          
@@ -58,7 +71,7 @@ class Graphics:
         self.Sand = (198, 166, 100)
         
         # Image taken from https://www.cleanpng.com/png-industrial-robotic-arm-in-action-8194578/
-        self.hhandle = pygame.image.load('imgs/hand.png') 
+        self.hhandle = self.assets.image('imgs/hand.png') 
         
         self.haptic_width = 48
         self.haptic_height = 48
@@ -68,8 +81,8 @@ class Graphics:
 
         # Make submarine
         # image taken from https://www.cleanpng.com/png-yellow-submarine-clip-art-submarine-biomass-vector-1902493/
-        self.submarine_left = pygame.transform.scale(pygame.image.load('imgs/yellow_submarine_left.png'), (150, 100))
-        self.submarine_right = pygame.transform.scale(pygame.image.load('imgs/yellow_submarine_right.png'), (150, 100))
+        self.submarine_left = self.assets.image('imgs/yellow_submarine_left.png', (150, 100))
+        self.submarine_right = self.assets.image('imgs/yellow_submarine_right.png', (150, 100))
         self.submarine_dir = self.submarine_left
 
         ####Pseudo-haptics dynamic parameters, k/b needs to be <1
@@ -78,13 +91,15 @@ class Graphics:
         
         # initial position
         self.window_scale = 3000 #2500 #pixels per meter
+        # Mass-spring-damper endpoint moved by sim_forces, 10 substeps per frame (see virtual_device.py)
+        self.sim_device = VirtualDevice(self.sim_k, self.sim_b, window_scale=self.window_scale)
         self.submarine_pos = (int(self.window_size[0]/2.0 - 80), 10)
         self.device_origin = (int(self.window_size[0]/2.0), 110)
         
         # Targets (Images taken from the links next to each image)
-        self.anchor_img = pygame.image.load('imgs/anchor.png') # https://www.cleanpng.com/png-anchor-anchor-rope-boat-water-7781743/
-        self.chest_img = pygame.image.load('imgs/chest.png') # https://www.cleanpng.com/png-icon-wooden-chest-hasp-keyhole-lid-brown-wooden-ch-7956299/
-        self.bottle_img = pygame.image.load('imgs/bottle.png') # https://www.cleanpng.com/png-red-ribbon-clean-minimalist-image-of-a-bottle-with-7945288/
+        self.anchor_img = self.assets.image('imgs/anchor.png') # https://www.cleanpng.com/png-anchor-anchor-rope-boat-water-7781743/
+        self.chest_img = self.assets.image('imgs/chest.png') # https://www.cleanpng.com/png-icon-wooden-chest-hasp-keyhole-lid-brown-wooden-ch-7956299/
+        self.bottle_img = self.assets.image('imgs/bottle.png') # https://www.cleanpng.com/png-red-ribbon-clean-minimalist-image-of-a-bottle-with-7945288/
         self.anchor = self.anchor_img.get_rect(topleft=(500, 510))
         self.chest = self.chest_img.get_rect(topleft=(50, 263))
         self.bottle = self.bottle_img.get_rect(topleft=(200, 555))
@@ -95,36 +110,30 @@ class Graphics:
         self.table = pygame.Rect(630, 400, 800, 25)
         self.ground = pygame.Rect(185, 575, 415, 50)
 
+        # The water and the background elements do not move, they are drawn once into layers (see layers.py)
+        self.water_layer = Layer(self.window_size, self.draw_water)
+        self.terrain_layer = Layer(self.window_size, self.draw_terrain, [self.wall, self.platform, self.table, self.ground])
+        # Only the parts of the window that changed are updated, False to always flip the whole window
+        self.dirty_rects = True
+        self.dirty = DirtyRects(self.window_size)
+        # Stage times of the loop (see profiler.py), disabled until 'p' is pressed
+        self.profiler = Profiler()
+        self.profiler_lines = None # lines of the overlay rendered in profiler_texts
+        self.profiler_texts = []
+
         self.show_linkages = True
         
         # Currents
         self.current_pos = np.array([0,1200])
-        self.current = pygame.transform.scale(pygame.image.load('imgs/current_line.png'), (800, 120))
+        self.current = self.assets.image('imgs/current_line.png', (800, 120))
         self.current_rect = self.current.get_rect(topleft=self.current_pos)
         
         # Fish image from https://www.pngegg.com/en/png-exrop
-        self.fish_left = pygame.transform.scale(pygame.image.load('imgs/fish_left.png'), (40, 20))
-        self.fish_right = pygame.transform.scale(pygame.image.load('imgs/fish_right.png'), (40, 20))
+        self.fish_left = self.assets.image('imgs/fish_left.png', (40, 20))
+        self.fish_right = self.assets.image('imgs/fish_right.png', (40, 20))
 
-        # Init number of fishes and positions
-        self.fish = [0,0,0]
-
-        self.fish_dir = np.array([self.fish_right, self.fish_left, self.fish_right])
-        self.fish_pos = [[200,500],[500,400],[400,550]]
-        self.fish_mode = np.array([1,-1, 1])
-        
-        fish1 =self.fish_dir[0].get_rect(topleft=self.fish_pos[0])
-        fish2 =self.fish_dir[1].get_rect(topleft=self.fish_pos[1]) 
-        fish3 =self.fish_dir[2].get_rect(topleft=self.fish_pos[2]) 
-        
-        self.fish_rect = np.array([fish1, fish2, fish3])
-        
-        if(num_fish >= 1):
-            self.fish[0] = 1
-        if(num_fish >= 2):
-            self.fish[1] = 1
-        if(num_fish >= 3):
-            self.fish[2] = 1
+        # Fish of the scene, the first num_fish of the three classic ones are swimming, more are placed with rng
+        self.fish = FishSwarm.default(num_fish, rng)
 
     def convert_pos(self,*positions):
         #invert x because of screen axes
@@ -164,6 +173,8 @@ class Graphics:
         
     def get_events(self):
         #########Process events  (Mouse, Keyboard etc...)#########
+        if self.headless:
+            return []
         events = pygame.event.get()
         keyups = []
         for event in events:
@@ -171,43 +182,25 @@ class Graphics:
                 sys.exit(0) #raises a system exit exception so any Finally will actually execute
             elif event.type == pygame.KEYUP:
                 keyups.append(event.key)
+            elif event.type == pygame.WINDOWEXPOSED: #the window has to be drawn again
+                self.dirty.invalidate()
         
         return keyups
 
-    def sim_forces(self,pE,f,pM,mouse_k=None,mouse_b=None):
+    def sim_forces(self,pE,f,pM,mouse_k=None,mouse_b=None,dt=None):
         #simulated device calculations
         if mouse_k is not None:
             self.sim_k = mouse_k
         if mouse_b is not None:
             self.sim_b = mouse_b
         if not self.device_connected:
-            pP = self.haptic.center
             #pM is where the mouse is
             #pE is where the position is pulled towards with the spring and damping factors
-            #pP is where the actual haptic position ends up as
+            #dt is the length of the frame in s, measured from the previous call if None
             diff = np.array(( pM[0]-pE[0],pM[1]-pE[1]) )
-            #diff = np.array(( pM[0]-pP[0],pM[1]-pP[1]) )
-            
-            scale = self.window_scale/1e3
-            scaled_vel_from_force = np.array(f)*scale/self.sim_b
-            vel_from_mouse_spring = (self.sim_k/self.sim_b)*diff
-            dpE = vel_from_mouse_spring - scaled_vel_from_force
-            #dpE = -dpE
-            #if diff[0]!=0:
-            #    if (diff[0]+dpE[0])/diff[0]<0:
-            #        #adding dpE has changed the sign (meaning the distance that will be moved is greater than the original displacement
-            #        #prevent the instantaneous velocity from exceeding the original displacement (doesn't make physical sense)
-            #        #basically if the force given is so high that in a single "tick" it would cause the endpoint to move back past it's original position...
-            #        #whatever thing is exerting the force should basically be considered a rigid object
-            #        dpE[0] = -diff[0]
-            #if diff[1]!=1:
-            #    if (diff[1]+dpE[1])/diff[1]<0:
-            #        dpE[1] = -diff[1]
-            if abs(dpE[0])<1:
-                dpE[0] = 0
-            if abs(dpE[1])<1:
-                dpE[1] = 0
-            pE = np.round(pE+dpE) #update new positon of the end effector
+            self.sim_device.k = self.sim_k
+            self.sim_device.b = self.sim_b
+            pE = self.sim_device.step(pE,f,pM,dt) #update new positon of the end effector (float pixels)
             
             #Change color based on effort
             cg = 255-np.clip(np.linalg.norm(self.sim_k*diff/self.window_scale)*255*20,0,255)
@@ -216,8 +209,12 @@ class Graphics:
         return pE
 
     def erase_screen(self):
-        # plot hight map
-        self.screenHaptics.fill(self.cWhite) #erase the haptics surface
+        if self.headless:
+            return
+        # plot hight map where something was drawn in the last frame
+        self.water_layer.blit(self.screenHaptics, self.dirty.previous)
+
+    def draw_water(self, surface):
         pixels = np.zeros((self.window_size[1], self.window_size[0], 3), dtype=np.uint8)  # Create empty image
         Y_color = np.linspace(255, 100, self.window_size[1])[:, None]  # Gradient from 255 (top) to 0 (bottom)
 
@@ -227,117 +224,136 @@ class Graphics:
         pixels[:, :, 2] = Y_color
 
         # Convert array to surface
-        surface = pygame.surfarray.make_surface(pixels.swapaxes(0, 1))
-        self.screenHaptics.blit(surface, (0, 0))
+        surface.blit(pygame.surfarray.make_surface(pixels.swapaxes(0, 1)), (0, 0))
+
+    def draw_terrain(self, surface):
+        pygame.draw.rect(surface,self.dBrown,self.wall)
+        pygame.draw.rect(surface,self.dGray,self.platform)
+        pygame.draw.rect(surface,self.bGray,self.table)
+        pygame.draw.rect(surface,self.Sand,self.ground)
+
+    def invalidate_background(self):
+        # Redraw the static layers, call it after changing the background elements
+        self.terrain_layer.areas = [self.wall, self.platform, self.table, self.ground]
+        self.water_layer.invalidate()
+        self.terrain_layer.invalidate()
     
-    def render(self,pA0,pB0,pA,pB,pE,f,pM, pS, st, dam):
-        ###################Render the Haptic Surface###################
+    def update(self, pE, pS):
+        # Move the scene to the new endpoint (pE) and submarine (pS) positions, used by the collision checks
         #set new position of items indicating the endpoint location
-        self.screenHaptics.blit(self.current, self.current_pos)
-        
         self.haptic.center = pE #the hhandle image and effort square will also use this position for drawing
         self.effort_cursor.center = self.haptic.center
 
+        # Submarine 
+        if self.submarine_pos[0] < pS[0]:
+            self.submarine_dir = self.submarine_right
+        elif self.submarine_pos[0] > pS[0]:
+            self.submarine_dir = self.submarine_left
+            
+        self.submarine_pos = tuple(pS)
+        self.device_origin = (pS[0] + 75, pS[1] + 90)
+
+    def render(self,pA0,pB0,pA,pB,pE,f,pM, pS, st, dam):
+        if self.headless:
+            return
+
+        ###################Render the Haptic Surface###################
+        # Everything that moves adds the rect it covers to the dirty rects
+        dirty = self.dirty.add
+        # Fish
+        for rect in self.screenHaptics.blits(self.fish.sprites(self.fish_right, self.fish_left)):
+            dirty(rect)
+
+        dirty(self.screenHaptics.blit(self.current, self.current_pos))
+
         # Draw Object
-        self.screenHaptics.blit(self.anchor_img, self.anchor)
-        self.screenHaptics.blit(self.chest_img, self.chest)
-        self.screenHaptics.blit(self.bottle_img, self.bottle)
+        dirty(self.screenHaptics.blit(self.anchor_img, self.anchor))
+        dirty(self.screenHaptics.blit(self.chest_img, self.chest))
+        dirty(self.screenHaptics.blit(self.bottle_img, self.bottle))
 
         # Draw Background elements
-        pygame.draw.rect(self.screenHaptics,self.dBrown,self.wall)
-        pygame.draw.rect(self.screenHaptics,self.dGray,self.platform)
-        pygame.draw.rect(self.screenHaptics,self.bGray,self.table)
-        pygame.draw.rect(self.screenHaptics,self.Sand,self.ground)
+        self.terrain_layer.blit(self.screenHaptics)
 
         ######### Robot visualization ###################
         if self.show_linkages:
-            pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pA0,pA],5)
-            pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pB0,pB],5)
-            pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pA,pE],5)
-            pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pB,pE],5)
+            dirty(pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pA0,pA],5))
+            dirty(pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pB0,pB],5))
+            dirty(pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pA,pE],5))
+            dirty(pygame.draw.lines(self.screenHaptics, self.cYellow, False,[pB,pE],5))
             
             for p in ( pA0,pB0,pA,pB,pE):
-                pygame.draw.circle(self.screenHaptics, (0, 0, 0),p, 5)
+                dirty(pygame.draw.circle(self.screenHaptics, (0, 0, 0),p, 5))
                 pygame.draw.circle(self.screenHaptics, (200, 200, 200),p, 2)
         
         ### Gripper visualisation
         hand_pos = (self.effort_cursor[0], self.effort_cursor[1] + 10)
-        self.screenHaptics.blit(self.hhandle, hand_pos)
+        dirty(self.screenHaptics.blit(self.hhandle, hand_pos))
         
         # Submarine 
-        if self.submarine_pos[0] < pS[0]:
-            self.submarine_dir = self.submarine_right
-        elif self.submarine_pos[0] > pS[0]:
-            self.submarine_dir = self.submarine_left
-            
-        self.submarine_pos = tuple(pS)
-        self.device_origin = (pS[0] + 75, pS[1] + 90)
-        self.screenHaptics.blit(self.submarine_dir, self.submarine_pos)
+        dirty(self.screenHaptics.blit(self.submarine_dir, self.submarine_pos))
 
         # Display time
-        remaining_time = max(0, self.max_time - (time.time() - st))
+        remaining_time = max(0, self.max_time - (self.clock_time() - st))
         time_text = f"T: {int(remaining_time//60)}:{int(remaining_time%60)}"
-        time_font = pygame.font.Font('freesansbold.ttf', 20)
-        time_text = time_font.render(time_text, True, (255, 255, 255), (0, 0, 0))
+        time_text = self.text_cache.render(time_text, 20, (255, 255, 255), (0, 0, 0))
         time_text_rect = time_text.get_rect()
         time_text_rect.bottomleft = (5, 600)
-        self.screenHaptics.blit(time_text, time_text_rect)
+        dirty(self.screenHaptics.blit(time_text, time_text_rect))
 
         # Display damage
-        damage_text = "Health: "
-        damage_font = pygame.font.Font('freesansbold.ttf', 20)
-        damage_text = damage_font.render(damage_text, True, (255, 255, 255), (0, 0, 0))
+        damage_text = self.text_cache.render("Health: ", 20, (255, 255, 255), (0, 0, 0))
         damage_text_rect = damage_text.get_rect()
         damage_text_rect.bottomleft = (615, 599)
-        self.screenHaptics.blit(damage_text, damage_text_rect)
-        pygame.draw.rect(self.screenHaptics, (100, 100, 100), (695, 573, 100, 25), border_radius=5)
+        dirty(self.screenHaptics.blit(damage_text, damage_text_rect))
+        dirty(pygame.draw.rect(self.screenHaptics, (100, 100, 100), (695, 573, 100, 25), border_radius=5))
         # Draw damage level (green - 0% -> red - 100%)
         pygame.draw.rect(self.screenHaptics, (255 * ((min(dam,100)/100)), 255 * (1-(min(dam,100)/100)), 0), (695, 573, 100 * (1-(min(dam,100)/100)), 25), border_radius=5)
 
-        ##Fuse it back together
-        self.window.blit(self.screenHaptics, (0,0))
+        # Stage times of the loop, 'p' toggles the profiler
+        if self.profiler.enabled:
+            self.draw_profiler(5, 5)
 
-        pygame.display.flip()    
+        ##Fuse it back together, only the dirty rects unless most of the window changed
+        with self.profiler.stage("flip"):
+            self.dirty.present(self.window, self.screenHaptics, self.dirty_rects)
         ##Slow down the loop to match FPS
-        self.clock.tick(self.FPS)
+        with self.profiler.stage("wait"):
+            self.clock.tick(self.FPS)
     
+    def draw_profiler(self, x, y):
+        # Overlay of the profiler, one line per stage. The lines only change when the profiler refreshes them, they
+        # are rendered then and not through the text cache
+        lines = self.profiler.overlay()
+        if lines is not self.profiler_lines:
+            self.profiler_lines = lines
+            font = self.text_cache.font(14)
+            self.profiler_texts = [font.render(line, True, (255, 255, 255), (0, 0, 0)) for line in lines]
+        for text in self.profiler_texts:
+            self.dirty.add(self.screenHaptics.blit(text, (x, y)))
+            y += text.get_height()
+
     def show_loading_screen(self, i=0):
         # Show Intro message with loading dots
-        if (i % 15000 == 0):
+        if (i % 15000 == 0) and not self.headless:
             self.window.fill(self.cBlack)
             dots_cycle = ["", ".", "..", "...", "....", ".....", "......", ".......","........", ".........",".........."]
             init_text = "WAITING FOR COMMUNICATION: " + dots_cycle[((i//15000) % 11)]
-            init_font = pygame.font.Font('freesansbold.ttf', 35)
-            init_text = init_font.render(init_text, True, (0, 255, 0), (0, 0, 0))
+            init_text = self.text_cache.render(init_text, 35, (0, 255, 0), (0, 0, 0))
             init_text_rect = init_text.get_rect()
             init_text_rect.topleft = (50, 300)
             self.window.blit(init_text, init_text_rect)
             pygame.display.flip()
+            self.dirty.invalidate()
         return 0
 
     # FISH
-    def render_fish(self):
-        # Update Fish position and direction 
-        for n, f in enumerate(self.fish):
-            if(f == 1):
-                self.screenHaptics.blit(self.fish_dir[n], self.fish_pos[n])
-                
-                if self.fish_pos[n][0] >= 550 and self.fish_mode[n] == 1:
-                    self.fish_mode[n] = -1
-                    self.fish_dir[n] = self.fish_left
-                elif self.fish_pos[n][0] <= 200 and self.fish_mode[n] == -1:
-                    self.fish_mode[n] = 1
-                    self.fish_dir[n] = self.fish_right
-                    
-                self.fish_pos[n][0] += self.fish_mode[n]
-                pos_new = [0,0]
-                pos_new[0] = self.fish_pos[n][0] 
-                pos_new[1] = self.fish_pos[n][1]
-
-                fish_new =self.fish_dir[n].get_rect(topleft=pos_new) 
-                
-                self.fish_rect[n] = fish_new
+    def update_fish(self, dt=0.01):
+        # Update Fish position and direction, they swim 100 pixels per second
+        self.fish.update(dt)
 
     def close(self):
+        if self.headless:
+            # Other sessions of the same process may still be using pygame
+            return
         pygame.display.quit()
         pygame.quit()
@@ -9,6 +9,7 @@ import serial
 import struct
 import math
 import sys
+import numpy as np
 from typing import List
 import array
 
@@ -709,6 +710,66 @@ class Pantograph(Mechanisms):
         self.__tau1*= self.__gain
         self.__tau2*= self.__gain
 
+    def forwardKinematicsBatch(self, angles):
+        # Same as forwardKinematics for an (N,2) array of encoder angles in degrees, e.g. a recorded log.
+        # Nothing is stored, returns the (N,2) endpoint positions and the (N,2,2) Jacobians
+        # [[J11, J12], [J21, J22]]. Angles for which the arms cannot close give NaN
+        l1 = l2 = self.__l
+        L1 = L2 = self.__L
+        angles = np.asarray(angles, dtype=np.float64).reshape(-1, 2)
+        th1 = self.__pi / 180 * angles[:, 0]
+        th2 = self.__pi / 180 * angles[:, 1]
+
+        c1 = np.cos(th1)
+        c2 = np.cos(th2)
+        s1 = np.sin(th1)
+        s2 = np.sin(th2)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xA = l1 * c1
+            yA = l1 * s1
+            xB = self.__d + l2 * c2
+            yB = l2 * s2
+            hx = xB - xA
+            hy = yB - yA
+            hh = hx**2 + hy**2
+            hm = np.sqrt(hh)
+            cB = np.where(hm == 0, 0, -(L2**2 - L1**2 - hh) / (2 * L1 * hm))
+            h1x = np.where(hm == 0, 0, L1 * cB * hx / hm)
+            h1y = np.where(hm == 0, 0, L1 * cB * hy / hm)
+            h1m = np.sqrt(h1x**2 + h1y**2)
+            sB = np.sqrt(1 - cB**2)
+            lx = np.where(h1m == 0, 0, -L1 * sB * h1y / h1m)
+            ly = np.where(h1m == 0, 0, L1 * sB * h1x / h1m)
+
+            x_P = xA + h1x + lx
+            y_P = yA + h1y + ly
+
+            phi1 = np.arccos((x_P - l1 * c1) / L1)
+            phi2 = np.arccos((x_P - self.__d - l2 * c2) / L2)
+
+            c11 = np.cos(phi1)
+            s11 = np.sin(phi1)
+            c22 = np.cos(phi2)
+            s22 = np.sin(phi2)
+
+            dn = L1 * (c11 * s22 - c22 * s11)
+            eta = np.where(dn == 0, 0, (-L1 * c11 * s22 + L1 * c22 * s11 - c1 * l1 * s22 + c22 * l1 * s1) / dn)
+            nu = np.where(dn == 0, 0, l2 * (c2 * s22 - c22 * s2) / dn)
+
+        J = np.empty((len(angles), 2, 2))
+        J[:, 0, 0] = -L1 * eta * s11 - L1 * s11 - l1 * s1
+        J[:, 0, 1] = L1 * c11 * eta + L1 * c11 + c1 * l1
+        J[:, 1, 0] = -L1 * s11 * nu
+        J[:, 1, 1] = L1 * c11 * nu
+        return np.stack((x_P, y_P), axis=-1), J
+
+    def torqueCalculationBatch(self, J, forces):
+        # Same as torqueCalculation for (N,2,2) Jacobians from forwardKinematicsBatch and (N,2) forces.
+        # Returns the (N,2) torques
+        forces = np.asarray(forces, dtype=np.float64)
+        return self.__gain * np.einsum("nij,nj->ni", J, forces.reshape(-1, 2))
+
     def op_velocityCalculation(self, q):
         op_vels = [0.0,0.0]
         self.__q_x = q[0]
@@ -109,14 +109,16 @@ class Physics:
         pB = ( self.l1*math.cos(a2)+self.d, self.l1*math.sin(a2) )
         return pA0,pB0,pA,pB,device_position
     
-    def update_force(self,f):
+    def update_force(self,f,wait=True):
         #Send forces to the device. Only works if a device is connected!
+        #wait=False skips the 1 ms pause, for callers that pace the device loop themselves (see DeviceServo)
         if self.device_present and self.port:
             #update and send torques
             f[1] = -f[1] #graphical y axis is reversed
             self.device.set_device_torques( f ) #forces in cartesian coordinates. Calculates the needed motor torques.
             self.device.device_write_torques()
-            time.sleep(0.001) #pause for 1 millisecond
+            if wait:
+                time.sleep(0.001) #pause for 1 millisecond
         elif not self.device_present:
             print("debug vals:",self.device_present,self.port)
             raise ValueError("[PHYSICS] Cannot set device force if no device is connected!")
@@ -187,6 +189,47 @@ class Physics:
         #pA0,pB0,pA,pB,pE
         return pA0,pB0,pA,pB,pe
     
+    def derive_device_pos_batch(self,pe):
+        #same as derive_device_pos for many endpoints at once, without the per point branches and exceptions
+        #pe: (N,2) endpoint locations (not modified)
+        #returns pA0, pB0 (base points) and the (N,2) arrays pA, pB and pE (endpoints moved into the workspace)
+        pe = np.array(pe, dtype=np.float64).reshape(-1,2)
+        pA0 = (0.0,0.0)
+        pB0 = (pA0[0]+self.d,pA0[1])
+        base_A = np.array(pA0)
+        base_B = np.array(pB0)
+        distance_margin = 0.0005 #m
+        max_arm_length = self.l1+self.l2-distance_margin
+        min_dist = self.l2-self.l1+distance_margin
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dA0 = np.hypot(pe[:,0]-pA0[0], pe[:,1]-pA0[1])
+            dB0 = np.hypot(pe[:,0]-pB0[0], pe[:,1]-pB0[1])
+            #pantograph overextended: move the endpoint to the maximum extension along the line from the farthest base point
+            over = (dA0>max_arm_length) | (dB0>max_arm_length)
+            far_A = (dA0>dB0)[:,None]
+            base = np.where(far_A, base_A, base_B)
+            dist = np.where(far_A[:,0], dA0, dB0)[:,None]
+            pe = np.where(over[:,None], base+(pe-base)/dist*max_arm_length, pe)
+            #pantograph too close to the base: restrict y
+            close = ~over & (pe[:,1]<pA0[1]+min_dist)
+            pe[close,1] = pA0[1]+min_dist
+
+            #find valid angles, points out of the domain of acos get both angles at 0
+            dA0 = np.hypot(pe[:,0]-pA0[0], pe[:,1]-pA0[1])
+            cA = (self.l1**2+dA0**2-self.l2**2)/(2*self.l1*dA0)
+            theta_A0 = np.arctan2(pe[:,1]-pA0[1], pe[:,0]-pA0[0]) + np.arccos(cA)
+            dB0 = np.hypot(pe[:,0]-pB0[0], pe[:,1]-pB0[1])
+            cB = (self.l1**2+dB0**2-self.l2**2)/(2*self.l1*dB0)
+            theta_B0 = np.arctan2(pe[:,1]-pB0[1], pe[:,0]-pB0[0]) - np.arccos(cB)
+        valid = (np.abs(cA)<=1) & (np.abs(cB)<=1)
+        theta_A0 = np.where(valid, theta_A0, 0.0)
+        theta_B0 = np.where(valid, theta_B0, 0.0)
+
+        pA = np.stack((self.l1*np.cos(theta_A0)+pA0[0], self.l1*np.sin(theta_A0)+pA0[1]), axis=-1) #intermediate points A
+        pB = np.stack((self.l1*np.cos(theta_B0)+pB0[0], self.l1*np.sin(theta_B0)+pB0[1]), axis=-1) #intermediate points B
+        return pA0,pB0,pA,pB,pe
+    
     def close(self):
         if self.device_present and self.port:
             #reset the force to 0, otherwise it will stay nonzero
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Images of the game, loaded once per process and shared by both windows and by the trials replayed in it. Most of the
+# startup is spent decoding the large source images (the fish are 2400x1645 and drawn at 40x20), so the scaled
+# variants can also be saved to a cache folder and loaded from there by the next process:
+#
+#   SUBMARINE_ASSET_CACHE=.asset_cache python submarine.py
+import os
+
+import pygame
+
+
+class Assets:
+    #   cache_dir: folder of the scaled images, None to keep them only in memory
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.sources = {} # path -> image as loaded
+        self.scaled = {} # (path, size) -> scaled image
+        self.surfaces = {} # (path, size, converted) -> image ready to blit
+
+    def image(self, path, size=None):
+        # Image of the file at path scaled to size (None for its own size). Once there is a window it is converted
+        # to the pixel format of the window, so blits are plain copies. The surfaces are shared, do not draw on them
+        converted = pygame.display.get_surface() is not None
+        key = (path, size, converted)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.source(path) if size is None else self.scale(path, size)
+            if converted:
+                surface = surface.convert_alpha()
+            self.surfaces[key] = surface
+        return surface
+
+    def source(self, path):
+        surface = self.sources.get(path)
+        if surface is None:
+            surface = self.sources[path] = pygame.image.load(path)
+        return surface
+
+    def scale(self, path, size):
+        size = tuple(size)
+        surface = self.scaled.get((path, size))
+        if surface is not None:
+            return surface
+        cached = self.cache_path(path, size)
+        if cached is not None and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+            surface = pygame.image.load(cached)
+        else:
+            surface = pygame.transform.scale(self.source(path), size)
+            if cached is not None:
+                # Written under another name first, trials running in parallel may load it meanwhile
+                os.makedirs(self.cache_dir, exist_ok=True)
+                temp = f"{cached}.{os.getpid()}.png"
+                pygame.image.save(surface, temp)
+                os.replace(temp, cached)
+        self.scaled[(path, size)] = surface
+        return surface
+
+    def cache_path(self, path, size):
+        if self.cache_dir is None:
+            return None
+        name = os.path.splitext(path)[0].replace(os.sep, "_").replace("/", "_")
+        return os.path.join(self.cache_dir, f"{name}_{size[0]}x{size[1]}.png")
+
+
+# Shared by everything in the process
+shared = Assets(os.environ.get("SUBMARINE_ASSET_CACHE"))
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Objects of the scene as rigid boxes under water: they sink when nothing holds them, rest on the background and
+# hang from the gripper by a spring joint, whose pull, smoothed and bounded, is the force the operator feels.
+# Bodies that came to rest fall asleep and are skipped until something wakes them up, and contacts are only tested
+# against the boxes of the grid cells a body is in (see colliders.py), so idle objects cost nothing.
+from colliders import ColliderWorld, Collider
+
+
+class Body:
+    # Box moved by the simulation. rect is a pygame.Rect shared with the graphics and the gripper colliders, it is
+    # set from the float position every step.
+    #   mass (kg), density (kg/m^3): the weight minus the buoyancy pulls the body down
+    #   drag: water damping (N per m/s), sets how fast the body sinks
+    def __init__(self, name, rect, mass, density=2500, drag=20.0):
+        self.name = name
+        self.rect = rect
+        self.mass = mass
+        self.density = density
+        self.drag = drag
+        self.x = float(rect.left) # top left corner (pixels)
+        self.y = float(rect.top)
+        self.vx = 0.0 # pixels per second
+        self.vy = 0.0
+        self.awake = False
+        self.still = 0.0 # time resting without moving (s)
+        self.touching = set() # names of the boxes touched in the last step
+
+
+class BodyWorld:
+    # sleep_speed: speed below which a resting body counts as still (pixels per second)
+    # sleep_time: how long it has to stay still to fall asleep (s)
+    def __init__(self, window_scale=3000, gravity=9.81, water_density=1025, sleep_speed=2.0, sleep_time=0.3, cell=64):
+        self.scale = window_scale
+        self.gravity = gravity
+        self.water_density = water_density
+        self.sleep_speed = sleep_speed
+        self.sleep_time = sleep_time
+        self.bodies = []
+        self.awake = []
+        self.grid = ColliderWorld(cell=cell) # broad phase of the static boxes and the bodies
+        self.owner = {} # collider of the grid -> body (None for static boxes)
+        self.collider = {} # body -> its collider in the grid
+        # Spring joint between the grabbed body and the gripper
+        self.grabbed = None
+        self.joint_k = 3000.0 # N/m, the anchor (8.5 N in water) hangs about 8.5 pixels below the joint target
+        self.joint_c = 60.0 # N per m/s
+        self.joint_target = (0.0, 0.0) # where the joint pulls the top left corner of the grabbed body (pixels)
+        # The gripper is not part of this step, so the raw pull of the stiff spring fed back to it makes it swing
+        # (about 6 pixels per N on the virtual device). It gets the pull low-pass filtered with a time constant of
+        # joint_filter (s), at most joint_max (N) away from the net weight of the body
+        self.joint_filter = 0.2
+        self.joint_max = 2.0
+        self.joint_pull = (0.0, 0.0) # filtered pull of the spring (N)
+        self.joint_weight = 0.0 # filtered net weight (N)
+        self.joint_force = (0.0, 0.0) # force of the joint on the gripper in screen axes (N)
+
+    def add_static(self, name, rect):
+        self.owner[self.grid.add(Collider(name, rect))] = None
+
+    def add(self, body):
+        self.bodies.append(body)
+        collider = self.grid.add(Collider(body.name, body.rect))
+        self.owner[collider] = body
+        self.collider[body] = collider
+        return body
+
+    def wake(self, body):
+        if not body.awake:
+            body.awake = True
+            body.still = 0.0
+            self.awake.append(body)
+
+    def wake_above(self, body):
+        # Wake the bodies resting on top of body, they lose their support
+        r = body.rect
+        for c in self.grid.query(r.left, r.top - 1, r.right, r.top):
+            other = self.owner[c]
+            if other is not None and other is not body and other.rect.bottom <= r.top + 1:
+                self.wake(other)
+
+    def grab(self, body, target):
+        self.grabbed = body
+        self.joint_target = target
+        self.wake(body)
+        self.wake_above(body)
+
+    def release(self):
+        # The grabbed body sinks from where it is
+        if self.grabbed is not None:
+            self.wake(self.grabbed)
+        self.grabbed = None
+        self.joint_pull = (0.0, 0.0)
+        self.joint_weight = 0.0
+        self.joint_force = (0.0, 0.0)
+
+    def step(self, dt):
+        # Semi-implicit Euler step of the awake bodies. Damping and the joint spring are integrated implicitly,
+        # so stiff joints and light bodies stay stable at the frame rate
+        s = self.scale
+        for body in list(self.awake):
+            # Weight minus buoyancy, y axis down (N)
+            fy = body.mass * self.gravity * (1 - self.water_density / body.density)
+            fx = 0.0
+            m = body.mass
+            damping = body.drag
+            k = 0.0
+            tx = ty = 0.0
+            if body is self.grabbed:
+                k = self.joint_k
+                damping += self.joint_c
+                tx, ty = self.joint_target
+            # (m + h*c + h^2*k) v' = m*v + h*s*F + h*k*(target - x), with positions in pixels and forces in N
+            den = m + dt * damping + dt * dt * k
+            body.vx = (m * body.vx + dt * s * fx + dt * k * (tx - body.x)) / den
+            body.vy = (m * body.vy + dt * s * fy + dt * k * (ty - body.y)) / den
+            body.x += dt * body.vx
+            body.y += dt * body.vy
+            if body is self.grabbed:
+                # The gripper is pulled by the joint towards the body
+                self.pull_gripper((k * (body.x - tx) + self.joint_c * body.vx) / s,
+                                  (k * (body.y - ty) + self.joint_c * body.vy) / s, fy, dt)
+            supported = self.resolve(body)
+            body.rect.topleft = (round(body.x), round(body.y))
+            self.grid.update(self.collider[body])
+
+            # Sleep when resting still for a while
+            if supported and body is not self.grabbed and abs(body.vx) < self.sleep_speed and abs(body.vy) < self.sleep_speed:
+                body.still += dt
+                if body.still >= self.sleep_time:
+                    body.awake = False
+                    body.vx = body.vy = 0.0
+                    self.awake.remove(body)
+            else:
+                body.still = 0.0
+
+    def pull_gripper(self, fx, fy, weight, dt):
+        # Force of the joint on the gripper from the pull (fx, fy) of the spring and the net weight of the body.
+        # Both are filtered, so the weight also ramps in after the grab, and the rest is clamped
+        alpha = dt / (self.joint_filter + dt)
+        px, py = self.joint_pull
+        px += alpha * (fx - px)
+        py += alpha * (fy - py)
+        self.joint_pull = (px, py)
+        self.joint_weight += alpha * (weight - self.joint_weight)
+        m = self.joint_max
+        self.joint_force = (min(max(px, -m), m), self.joint_weight + min(max(py - self.joint_weight, -m), m))
+
+    def resolve(self, body):
+        # Push the body out of the boxes it went into, along the axis of the smallest penetration.
+        # Returns whether it rests on something that does not move (a static box or a sleeping body)
+        w, h = body.rect.width, body.rect.height
+        body.touching = set()
+        supported = False
+        for c in self.grid.query(body.x, body.y, body.x + w, body.y + h + 1):
+            other = self.owner[c]
+            if other is body or (other is not None and body is self.grabbed):
+                # The joint holds the grabbed body, the bodies it hits make way
+                continue
+            r = c.rect
+            left = body.x + w - r.left
+            right = r.right - body.x
+            top = body.y + h - r.top
+            bottom = r.bottom - body.y
+            if min(left, right, bottom) <= 0 or top < 0:
+                continue
+            body.touching.add(c.name)
+            pen = min(left, right, top, bottom)
+            if pen == top:
+                # Resting contact, the water stops the sliding
+                body.y = r.top - h
+                body.vy = min(body.vy, 0.0)
+                body.vx *= 0.5
+                supported = supported or other is None or not other.awake
+            elif pen == bottom:
+                body.y = r.bottom
+                body.vy = max(body.vy, 0.0)
+            elif pen == left:
+                body.x = r.left - w
+                body.vx = min(body.vx, 0.0)
+            else:
+                body.x = r.right
+                body.vx = max(body.vx, 0.0)
+        return supported
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Contacts between the gripper and the scene (walls, platform, objects...) as axis-aligned boxes in a uniform grid,
+# so a query only tests the boxes of the cells the gripper is in.
+import numpy as np
+
+# Side of a collider touched by the gripper
+TOP = 1
+LEFT = 2
+RIGHT = 3
+
+
+class Collider:
+    # Box the gripper cannot go through. rect is a pygame.Rect, it can be shared with the graphics and moved:
+    # call ColliderWorld.update for dynamic colliders (or let resolve() do it every frame).
+    #   sides: sides the gripper can touch it from. The others are assumed to be out of reach (e.g. screen border)
+    #   reach: how far below the gripper position its lowest point touches this collider (pixels)
+    #   damage: damage added every frame the gripper is pushed against it
+    #   force: whether the contact is rendered as a wall force
+    def __init__(self, name, rect, sides=(TOP, LEFT, RIGHT), reach=12, damage=0.0, force=False, dynamic=False):
+        self.name = name
+        self.rect = rect
+        self.sides = sides
+        self.reach = reach
+        self.damage = damage
+        self.force = force
+        self.dynamic = dynamic
+        self.active = True # inactive colliders are ignored and keep their contact state
+        self.side = None # side of the current contact, kept until the gripper leaves the collider
+        self.index = 0 # insertion order, contacts are resolved in this order
+        self.cells = () # grid cells the collider is in
+        self.hashed = None # rect the cells were computed for
+
+
+class Contact:
+    def __init__(self, collider, side, depth):
+        self.collider = collider
+        self.side = side
+        self.depth = depth # how far the gripper went into the collider before it was pushed out (pixels)
+
+
+class ColliderWorld:
+    # half_width: half width of the gripper, top: how far above its position it reaches (pixels)
+    def __init__(self, half_width=20, top=24, cell=64):
+        self.half_width = half_width
+        self.top = top
+        self.cell = cell
+        self.colliders = []
+        self.grid = {} # (column, row) -> set of colliders
+
+    def add(self, collider):
+        collider.index = len(self.colliders)
+        self.colliders.append(collider)
+        self.update(collider)
+        return collider
+
+    def remove(self, collider):
+        for key in collider.cells:
+            self.grid[key].discard(collider)
+        collider.cells = ()
+        self.colliders.remove(collider)
+
+    def cells_of(self, left, top, right, bottom):
+        c = self.cell
+        return [(i, j) for i in range(int(left // c), int(right // c) + 1) for j in range(int(top // c), int(bottom // c) + 1)]
+
+    def update(self, collider):
+        # Move the collider to the cells of its current rect
+        r = collider.rect
+        if collider.hashed == r:
+            return
+        collider.hashed = r.copy()
+        cells = self.cells_of(r.left, r.top, r.right, r.bottom)
+        for key in collider.cells:
+            self.grid[key].discard(collider)
+        for key in cells:
+            self.grid.setdefault(key, set()).add(collider)
+        collider.cells = cells
+
+    def query(self, left, top, right, bottom):
+        # Colliders of the cells overlapping the box, in insertion order
+        found = set()
+        for key in self.cells_of(left, top, right, bottom):
+            found |= self.grid.get(key, set())
+        return sorted(found, key=lambda c: c.index)
+
+    def resolve(self, xh):
+        # Push the gripper at xh out of the colliders it touches. Returns the new position and the contacts.
+        # A contact keeps the side it started from until the gripper leaves the collider, so sliding along a
+        # wall does not switch it to another side
+        x, y = float(xh[0]), float(xh[1])
+        w = self.half_width
+        for c in self.colliders:
+            if c.dynamic:
+                self.update(c)
+        reach = max((c.reach for c in self.colliders), default=0)
+        candidates = self.query(x - w, y - self.top, x + w, y + reach)
+        for c in self.colliders:
+            if c.side is not None and c not in candidates:
+                candidates.append(c)
+        candidates.sort(key=lambda c: c.index)
+        contacts = []
+        for c in candidates:
+            if not c.active:
+                continue
+            r = c.rect
+            # Penetration from each side, positive when the gripper is inside
+            pen = {TOP: y + c.reach - r.top, LEFT: x + w - r.left, RIGHT: r.right - (x - w)}
+            if c.side is None:
+                if pen[TOP] > 0 and pen[LEFT] > 0 and pen[RIGHT] > 0 and y - self.top < r.bottom:
+                    # Entered from the side with the smallest penetration
+                    c.side = min(c.sides, key=lambda side: (pen[side], side == TOP))
+            elif pen[TOP] < 0 or pen[LEFT] < 0 or pen[RIGHT] < 0:
+                c.side = None
+            else:
+                contacts.append(Contact(c, c.side, pen[c.side]))
+                if c.side == TOP:
+                    y = r.top - c.reach
+                elif c.side == LEFT:
+                    x = r.left - w
+                else:
+                    x = r.right + w
+        return np.array([x, y]), contacts
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+
+
+class CurrentField:
+    # Horizontal force of the ocean currents, precomputed for every horizontal band of the scene and every step of
+    # the simulation, so the force at any point is an array lookup. Any number of currents can overlap, their
+    # forces are added when they are scheduled.
+    #   steps: number of simulation steps covered, dt: length of a step (s)
+    #   step0: clock step of the first column, the times of the currents are clock times (step * dt)
+    def __init__(self, steps, dt=0.01, num_sections=5, window_height=600, step0=0):
+        self.dt = dt
+        self.step0 = step0
+        self.num_sections = num_sections
+        self.section_height = window_height // num_sections
+        self.force = np.zeros((num_sections, steps)) # x force of each band at each step
+        self.y = np.full(steps, 1200) # top of the current drawn at each step, out of the screen if there is none
+        self.currents = [] # parameters of the scheduled currents
+
+    def add(self, section, amplitude, frequency, start, duration, direction):
+        # Schedule a current in band `section` starting at clock time `start` (s), it lasts `duration` s.
+        # The force is a sine that stops 0.2 s before the end
+        self.currents.append({"section": section, "amplitude": amplitude, "frequency": frequency,
+                              "start_time": start, "duration": duration, "direction": direction})
+        first = max(0, int(round(start / self.dt)) - self.step0)
+        steps = np.arange(first, min(len(self.y), first + int(math.ceil(duration / self.dt)) + 1))
+        elapsed = (steps + self.step0) * self.dt - start
+        active = elapsed < duration
+        steps, elapsed = steps[active], elapsed[active]
+        force = amplitude * np.sin(2 * math.pi * frequency * elapsed) * direction
+        force[elapsed > duration - 0.2] = 0
+        self.force[section, steps] += force
+        self.y[steps] = section * self.section_height
+
+    @classmethod
+    def generate(cls, rng, steps, dt=0.01, num_sections=5, window_height=600, step0=0, probability=0.1):
+        # Random schedule of the game: while there is no current, a new one starts every step with `probability`.
+        # Draws from rng in the same order as the currents were generated frame by frame
+        field = cls(steps, dt, num_sections, window_height, step0)
+        end = None # clock step at which the current one is over
+        for step in range(step0, step0 + steps):
+            start = step * dt
+            if rng.random() < probability and end is None:
+                section = rng.randint(2, num_sections - 1)
+                amplitude = rng.uniform(3, 4)
+                frequency = rng.uniform(0.5, 2.0)
+                duration = rng.uniform(2.0, 3.0)
+                direction = rng.choice([-1, 1])
+                field.add(section, amplitude, frequency, start, duration, direction)
+                end = step
+                while end * dt - start < duration:
+                    end += 1
+            elif end is not None and step >= end:
+                end = None
+        return field
+
+    def force_at(self, xh, step):
+        # Current force at the points xh (..., 2) at clock step `step`. A point on the border of two bands is in both
+        i = step - self.step0
+        xh = np.asarray(xh, dtype=np.float64)
+        f = np.zeros(xh.shape)
+        if i < 0 or i >= len(self.y):
+            return f
+        band = (xh[..., 1] // self.section_height).astype(int)
+        inside = (band >= 0) & (band < self.num_sections)
+        column = self.force[:, i]
+        f[..., 0] = np.where(inside, column[np.clip(band, 0, self.num_sections - 1)], 0)
+        border = (xh[..., 1] % self.section_height == 0) & (band >= 1) & (band <= self.num_sections)
+        f[..., 0] += np.where(border, column[np.clip(band - 1, 0, self.num_sections - 1)], 0)
+        return f
+
+    def force(self, xh, t):
+        # Current force at the points xh at clock time t (s), interpolated between steps
+        s = t / self.dt
+        s0 = int(math.floor(s))
+        a = s - s0
+        return (1 - a) * self.force_at(xh, s0) + a * self.force_at(xh, s0 + 1)
+
+    def y_at(self, step):
+        i = step - self.step0
+        if i < 0 or i >= len(self.y):
+            return 1200
+        return self.y[i]
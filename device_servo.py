@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import traceback
+
+import numpy as np
+
+
+class Mailbox:
+    # Single-slot mailbox: the writer overwrites the slot and the reader always gets the newest value.
+    # Storing and reading one attribute is atomic in CPython, so no lock is needed between the two threads.
+    def __init__(self, value=None):
+        self.slot = (value, time.perf_counter())
+
+    def put(self, value):
+        self.slot = (value, time.perf_counter())
+
+    def get(self):
+        return self.slot[0]
+
+    def age(self):
+        # Seconds since the value was written
+        return time.perf_counter() - self.slot[1]
+
+
+class DeviceServo(threading.Thread):
+    # Owns the Haply device and runs read -> force -> write at a fixed rate, independently of the render loop.
+    # The render/network loop only exchanges data with it through the position and force mailboxes.
+    # force_model, if set, is called with the endpoint position every iteration and its force is added to the
+    # mailbox force, so local contacts are rendered at device rate (model-mediated teleoperation).
+    def __init__(self, physics, rate=1000, force_model=None):
+        super().__init__(name="DeviceServo", daemon=True)
+        self.physics = physics
+        self.period = 1.0 / rate
+        self.running = False
+        self.loop_rate = 0 # measured rate in Hz, updated once per second
+        self.overruns = 0 # iterations that took longer than one period
+        self.force_model = force_model
+
+        # The device always has data available after Physics is initialized, so read the first sample here
+        self.position = Mailbox(physics.get_device_pos()) # pA0, pB0, pA, pB, pE in physical coordinates
+        self.force = Mailbox(np.zeros(2)) # fx, fy in device coordinates (already scaled by the operator)
+
+    def run(self):
+        p = self.physics
+        self.running = True
+        next_time = time.perf_counter()
+        count = 0
+        count_start = next_time
+        try:
+            while self.running:
+                # Read the newest position if the board answered the last torque command
+                if p.haplyBoard.data_available():
+                    self.position.put(p.get_device_pos())
+                # Write the newest force. update_force flips the y axis in place so send a copy
+                f = np.array(self.force.get(), dtype=np.float64)
+                force_model = self.force_model
+                if force_model is not None:
+                    f += force_model(self.position.get()[4])
+                p.update_force(f, wait=False)
+
+                # Keep the loop rate
+                count += 1
+                next_time += self.period
+                now = time.perf_counter()
+                if now < next_time:
+                    time.sleep(next_time - now)
+                else:
+                    self.overruns += 1
+                    next_time = now
+                if now - count_start >= 1.0:
+                    self.loop_rate = count / (now - count_start)
+                    count = 0
+                    count_start = now
+        except Exception:
+            print("[DeviceServo] Unhandled exception in the device thread:")
+            traceback.print_exc()
+            self.running = False
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(timeout=1.0)
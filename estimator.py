@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+import numpy as np
+
+
+class MotionEstimator:
+    # Velocity and acceleration of a point from timestamped positions, so the estimate does not depend on the
+    # loop rate. update(t, x) takes the time of the sample (s) and returns (v, a) in units of x per s and per s^2.
+    #   method "difference": backward differences of the last two samples (what calc_forces always did)
+    #   method "savgol": Savitzky-Golay style fit of a polynomial of degree `order` to the samples of the last
+    #   `span` seconds, derived at the newest sample. The span is in seconds, so the filter smooths the same at
+    #   100 Hz and at 1 kHz
+    #   size: length of the ring buffer of samples
+    def __init__(self, method="difference", span=0.04, order=2, size=64):
+        if method not in ("difference", "savgol"):
+            raise ValueError(f"Unknown estimator method: {method}")
+        self.method = method
+        self.span = span
+        self.order = order
+        self.samples = deque(maxlen=size) # (t, x)
+        self.v = 0
+        self.a = 0
+
+    def reset(self):
+        self.samples.clear()
+        self.v = 0
+        self.a = 0
+
+    def update(self, t, x):
+        x = np.array(x, dtype=np.float64)
+        if self.samples and t <= self.samples[-1][0]:
+            # Same or older sample, keep the last estimate
+            return self.v, self.a
+        self.samples.append((t, x))
+        if len(self.samples) < 2:
+            self.v = np.zeros_like(x)
+            self.a = np.zeros_like(x)
+        elif self.method == "difference":
+            (t0, x0), (t1, x1) = self.samples[-2], self.samples[-1]
+            v = (x1 - x0) / (t1 - t0)
+            self.a = (v - self.v) / (t1 - t0)
+            self.v = v
+        else:
+            self.v, self.a = self.fit(t)
+        return self.v, self.a
+
+    def fit(self, t):
+        # Least squares polynomial through the samples of the span, times relative to t
+        times = []
+        points = []
+        for ts, xs in reversed(self.samples):
+            if t - ts > self.span and len(times) > self.order:
+                break
+            times.append(ts - t)
+            points.append(xs)
+        order = min(self.order, len(times) - 1)
+        vander = np.vander(np.array(times), order + 1, increasing=True)
+        coefs = np.linalg.lstsq(vander, np.array(points), rcond=None)[0]
+        v = coefs[1]
+        a = 2 * coefs[2] if order >= 2 else np.zeros_like(v)
+        return v, a
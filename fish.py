@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import random
+
+import numpy as np
+
+
+class FishSwarm:
+    # All the fish of the scene as arrays, so moving them and testing them against the gripper costs about the
+    # same for 3 or 3000 fish.
+    #   pos: (N,2) top left corners in pixels, vel: (N,2) pixels per second
+    #   bounds: (N,2) left and right x where each fish turns around
+    def __init__(self, pos, vel, bounds, size=(40, 20)):
+        self.pos = np.array(pos, dtype=np.float64).reshape(-1, 2)
+        self.vel = np.array(vel, dtype=np.float64).reshape(-1, 2)
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 2)
+        self.alive = np.ones(len(self.pos), dtype=bool)
+        self.size = size
+
+    @classmethod
+    def default(cls, num_fish=2, rng=None, speed=100):
+        # The three fish of the original scene swimming between x=200 and x=550. More than three adds fish at
+        # random heights and speeds in the same area (rng is a random.Random)
+        pos = [[200, 500], [500, 400], [400, 550]]
+        vel = [[speed, 0], [-speed, 0], [speed, 0]]
+        bounds = [[200, 550]] * 3
+        if rng is None:
+            rng = random.Random()
+        for _ in range(3, num_fish):
+            pos.append([rng.uniform(200, 550), rng.uniform(330, 560)])
+            vel.append([rng.choice([-1, 1]) * rng.uniform(0.5, 1.5) * speed, 0])
+            bounds.append([200, 550])
+        swarm = cls(pos, vel, bounds)
+        swarm.alive[num_fish:] = False
+        return swarm
+
+    def __len__(self):
+        return len(self.pos)
+
+    def update(self, dt=0.01):
+        # Turn around at the bounds, then swim
+        x, vx = self.pos[:, 0], self.vel[:, 0]
+        turn = ((x >= self.bounds[:, 1]) & (vx > 0)) | ((x <= self.bounds[:, 0]) & (vx < 0))
+        vx[turn] = -vx[turn]
+        self.pos[self.alive] += self.vel[self.alive] * dt
+
+    def rects(self):
+        # left, top, right, bottom of every fish (rounded like pygame.Rect)
+        left = np.floor(self.pos[:, 0] + 0.5)
+        top = np.floor(self.pos[:, 1] + 0.5)
+        return left, top, left + self.size[0], top + self.size[1]
+
+    def hits(self, cursor, xh):
+        # Mask of the alive fish touching the gripper box `cursor` (pygame.Rect) or the cable of the gripper at xh,
+        # i.e. swimming above the gripper less than 50 px away from it horizontally
+        left, top, right, bottom = self.rects()
+        box = (cursor.left < right) & (left < cursor.right) & (cursor.top < bottom) & (top < cursor.bottom)
+        cable = (xh[1] >= self.pos[:, 1]) & (np.abs(self.pos[:, 0] - xh[0]) < 50)
+        return self.alive & (box | cable)
+
+    def sprites(self, right_img, left_img):
+        # (surface, position) pairs of the alive fish for Surface.blits
+        right = self.vel[:, 0] > 0
+        return [(right_img if r else left_img, (x, y)) for (x, y), r in zip(self.pos[self.alive].tolist(), right[self.alive])]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+def water_forces(xh, v, a, mass, water_density, b_water, object_mass, k_fish=50, fish_x=0, f_current=0,
+                 gravity=9.81, cross_sectional_area=(48 / 3000) ** 2, displaced_volume=(48 / 3000) ** 3,
+                 window_scale=3000):
+    # Force on the gripper of N environments at once, same terms and units as Submarine.calc_forces.
+    #   xh: (N,2) gripper positions in pixels, v: (N,2) velocities, a: (N,2) accelerations (as in calc_forces)
+    #   mass, water_density, b_water, object_mass (0 if nothing is grabbed), k_fish: (N,) or scalars
+    #   fish_x: (N,) x of the fish hitting each gripper, 0 for none. f_current: (N,2) current forces
+    # The other parameters are broadcast the same way. Returns the (N,2) forces
+    xh = np.asarray(xh, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    a = np.asarray(a, dtype=np.float64)
+    mass = np.asarray(mass, dtype=np.float64)
+    water_density = np.asarray(water_density, dtype=np.float64)
+    object_mass = np.asarray(object_mass, dtype=np.float64)
+    fish_x = np.asarray(fish_x, dtype=np.float64)
+
+    # The terms are summed in float32 up to the damping, then the inertia promotes the sum to float64, as
+    # calc_forces always did, so the same inputs give the same forces to the last bit
+    shape = np.broadcast_shapes(xh.shape, v.shape, a.shape)
+    f = np.zeros(shape, dtype=np.float32)
+    # Buoyancy and hydrostatic pressure at the depth of the gripper (y axis increases downward), and the current
+    depth = xh[..., 1] / window_scale
+    f_perturbation = np.zeros(shape)
+    f_perturbation[..., 1] = (-(mass * gravity - water_density * displaced_volume * gravity)
+                              + water_density * gravity * depth * cross_sectional_area)
+    f += f_perturbation + f_current
+
+    # Fish pushing the gripper to the right, proportional to how far it went into the gripper
+    penetration = np.maximum(0, fish_x + 40 - np.trunc(xh[..., 0]))
+    f[..., 0] += np.where(fish_x > 0, np.asarray(k_fish) * penetration / 600, 0).astype(np.float32)
+
+    # Damping of the water, inertia of the gripper and weight and inertia of the grabbed object
+    f -= np.asarray(b_water)[..., None] * v
+    f = f + (mass + object_mass)[..., None] * a
+    f[..., 1] -= 9.8 * object_mass
+    return f
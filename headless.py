@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# Headless submarine trials: no window, no UDP and a simulation clock that is not real time, so a trial runs as fast
+# as the CPU allows. The operator is replaced by a scripted input. With a seed every trial is reproducible.
+#
+#   python headless.py --trials 1000 --jobs 8 --max-time 60 --out headless_results.csv
+#   python headless.py --grab-hold
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+import protocol
+from sim_clock import SimClock
+from virtual_device import VirtualDevice
+
+
+class LissajousOperator:
+    # Scripted operator: moves the haptic endpoint along a fixed path with the same virtual device as
+    # Graphics.sim_forces, so the force feedback affects the motion.
+    def __init__(self, k=0.5, b=0.8, window_scale=3000):
+        self.device = VirtualDevice(k, b, window_scale=window_scale)
+        self.xh = np.array([350.0, 250.0])
+        self.xs = np.array([320.0, 10.0])
+        self.grab_object = False
+        self.t = None # time of the last position
+
+    def target(self, t):
+        # Lissajous sweep over the operator window (700x500)
+        return np.array([350 + 250 * math.sin(2 * math.pi * 0.13 * t), 250 + 180 * math.sin(2 * math.pi * 0.21 * t)])
+
+    def position(self, t, fe):
+        # POSITION payload at time t (s) given the last force of the submarine
+        fe = np.array(fe, dtype=np.float64)
+        fe[1] *= 0.5 # same scaling as RemoteOperator
+        dt = self.device.reference_dt if self.t is None else t - self.t
+        self.t = t
+        self.xh = np.clip(self.device.step(self.xh, fe, self.target(t), dt), 0, [700, 500])
+        return (self.xh[0], self.xh[1], self.xs[0], self.xs[1], self.grab_object)
+
+    def drop(self):
+        # The submarine dropped the object
+        self.grab_object = False
+
+
+class HoldOperator(LissajousOperator):
+    # Scripted operator that grabs the anchor at grab_time, lifts the mouse a little and holds it there
+    def __init__(self, grab_time=2.5, **kwargs):
+        super().__init__(**kwargs)
+        self.xs = np.array([450.0, 10.0]) # the gripper right above the anchor
+        self.grab_time = grab_time
+
+    def target(self, t):
+        return np.array([314.0, 431.0 - 100 * min(max((t - self.grab_time) / 3, 0), 1)])
+
+    def position(self, t, fe):
+        self.grab_object = t >= self.grab_time
+        return super().position(t, fe)
+
+
+class ScriptedLink:
+    # Stands in for the network link of a Submarine: positions come from `operator` at the simulation time of the
+    # clock, one per step, and the answers are kept
+    def __init__(self, operator, clock):
+        self.operator = operator
+        self.clock = clock
+        self.lost = False
+        self.position = None
+        self.position_time = None # simulation time of the position
+        self.seq = 0
+        self.force = np.zeros(2)
+        self.metrics = None
+
+    def step(self):
+        # Network time stamps stay in wall time like the real link
+        now = time.time()
+        payload = self.operator.position(self.clock(), self.force)
+        self.position = protocol.Message(protocol.POSITION, 0, self.seq, now, payload)
+        self.position.recv_time = now
+        self.position_time = self.clock()
+        self.seq += 1
+
+    def send(self, msg_type, *values):
+        if msg_type == protocol.FORCE:
+            self.force = np.array(values[:2])
+        elif msg_type == protocol.METRICS:
+            self.metrics = values
+        elif msg_type == protocol.DROP:
+            self.operator.drop()
+        return 0
+
+    def latest(self, msg_type):
+        if msg_type == protocol.POSITION:
+            if self.position is None or self.position_time != self.clock():
+                self.step()
+            return self.position
+        return None
+
+    def take(self, msg_type):
+        if msg_type == protocol.PLAY_AGAIN:
+            return protocol.Message(protocol.PLAY_AGAIN, 0, 0, time.time(), (False,))
+        return None
+
+    def connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def run_trial(operator=None, render_haptics=True, max_time=1 * 60, dt=0.01, seed=None, num_fish=2,
+              estimator="difference"):
+    # Play one game headless. Returns the metrics and how long it took.
+    # Imported here so the scripted operator can be used without pygame (see impairment_proxy.py)
+    from submarine import Submarine, EndGame
+    from estimator import MotionEstimator
+    clock = SimClock(dt)
+    link = ScriptedLink(operator if operator is not None else LissajousOperator(), clock)
+    submarine = Submarine(render_haptics, max_time=max_time, results_file=None, net=link, headless=True, wait=False,
+                          clock=clock, rng=random.Random(seed), num_fish=num_fish,
+                          estimator=MotionEstimator(estimator))
+    submarine.start()
+    start = time.perf_counter()
+    try:
+        while True:
+            submarine.run()
+    except EndGame:
+        pass
+    wall_time = time.perf_counter() - start
+    result = {
+        "passed": submarine.passed,
+        "time": clock() - submarine.init_time,
+        "path_length": submarine.path_length,
+        "damage": submarine.damage,
+        "frames": clock.steps,
+        "wall_time": wall_time,
+        "speedup": (clock() - submarine.init_time) / wall_time,
+    }
+    submarine.release()
+    return result
+
+
+def grab_hold(max_time=15, dt=0.01, seed=1, settle_time=5):
+    # Grab the anchor and hold it, the stiff joint must not make the gripper swing. Returns the object grabbed, how
+    # far the gripper moved (pixels) and the largest force sent (N) in the last settle_time s
+    from submarine import Submarine, EndGame
+    clock = SimClock(dt)
+    link = ScriptedLink(HoldOperator(), clock)
+    submarine = Submarine(True, max_time=max_time, results_file=None, net=link, headless=True, wait=False,
+                          clock=clock, rng=random.Random(seed), num_fish=0)
+    submarine.start()
+    positions = []
+    forces = []
+    grabbed = ""
+    try:
+        while True:
+            submarine.run()
+            grabbed = submarine.grabbed_object or grabbed
+            positions.append(submarine.graphics.haptic.center)
+            forces.append(link.force)
+    except EndGame:
+        pass
+    submarine.release()
+    last = int(settle_time / dt)
+    positions = np.array(positions[-last:])
+    return {
+        "grabbed": grabbed,
+        "range": (positions.max(axis=0) - positions.min(axis=0)).tolist(),
+        "max_force": np.abs(np.array(forces[-last:])).max(axis=0).tolist(),
+    }
+
+
+def _run_trial(args):
+    # Worker of the trial pool
+    trial, seed, render_haptics, max_time, dt, num_fish, estimator = args
+    result = run_trial(LissajousOperator(), render_haptics, max_time, dt, None if seed is None else seed + trial, num_fish,
+                       estimator)
+    result["trial"] = trial
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless submarine trials with a scripted operator")
+    parser.add_argument("--trials", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=1, help="trials run in parallel processes")
+    parser.add_argument("--max-time", type=float, default=60.0, help="length of a game in simulated s")
+    parser.add_argument("--dt", type=float, default=0.01, help="simulated time of a frame in s")
+    parser.add_argument("--no-haptics", action="store_true", help="the submarine sends zero forces")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--fish", type=int, default=2, help="number of fish in the scene")
+    parser.add_argument("--estimator", choices=["difference", "savgol"], default="difference",
+                        help="velocity and acceleration estimator of the gripper")
+    parser.add_argument("--asset-cache", default=".asset_cache",
+                        help="folder of the scaled images shared by the trials (see assets.py), empty to disable")
+    parser.add_argument("--out", default="headless_results.csv")
+    parser.add_argument("--grab-hold", action="store_true",
+                        help="only check that the gripper settles while it holds the anchor")
+    args = parser.parse_args()
+
+    # pygame is still used for rects and images, it does not need a display
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    if args.asset_cache:
+        os.environ.setdefault("SUBMARINE_ASSET_CACHE", args.asset_cache)
+
+    if args.grab_hold:
+        # The current still moves the gripper by about 20 pixels, a swinging joint by hundreds
+        result = grab_hold(dt=args.dt, seed=1 if args.seed is None else args.seed)
+        print(result)
+        assert result["grabbed"] == "anchor", "the anchor was not grabbed"
+        assert max(result["range"]) < 60, "the gripper does not settle while it holds the anchor"
+        assert max(result["max_force"]) < 20, "the force of the joint is not bounded"
+        raise SystemExit
+
+    fields = ["trial", "passed", "time", "path_length", "damage", "frames", "wall_time", "speedup"]
+    jobs = [(trial, args.seed, not args.no_haptics, args.max_time, args.dt, args.fish, args.estimator) for trial in range(args.trials)]
+    start = time.perf_counter()
+    with open(args.out, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        if args.jobs > 1:
+            pool = multiprocessing.get_context("spawn").Pool(args.jobs)
+            for result in pool.imap_unordered(_run_trial, jobs):
+                writer.writerow(result)
+            # pygame turns SIGTERM into a QUIT event, so let the workers exit instead of terminating the pool
+            pool.close()
+            pool.join()
+        else:
+            for job in jobs:
+                writer.writerow(_run_trial(job))
+    elapsed = time.perf_counter() - start
+    print(f"{args.trials} trials of {args.max_time:.0f} s in {elapsed:.1f} s, results saved to {args.out}")
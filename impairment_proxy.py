@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# UDP relay between the operator and the submarine that injects network impairments, and a benchmark mode
+# that sweeps the impairments with a scripted operator.
+#
+# Relay (run the operator and the submarine pointing to the proxy ports):
+#   python impairment_proxy.py relay --delay 20 --jitter 5 --loss 0.01
+#   python submarine.py name true 40011
+#   python remote_operator.py 40012
+#
+# Benchmark (starts the submarine and a scripted operator for every combination of parameters):
+#   python impairment_proxy.py bench --delay 0 10 50 --jitter 0 5 --loss 0 0.05 --duration 20
+import argparse
+import asyncio
+import csv
+import itertools
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+import protocol
+from network import Endpoint
+from latency import LatencyMonitor
+from headless import LissajousOperator
+
+OPERATOR_ADDR = ("127.0.0.1", 40001)
+SUBMARINE_ADDR = ("127.0.0.1", 40002)
+PROXY_SUBMARINE_SIDE = ("127.0.0.1", 40011) # the submarine sends here instead of to the operator
+PROXY_OPERATOR_SIDE = ("127.0.0.1", 40012) # the operator sends here instead of to the submarine
+
+
+class Impairment:
+    # Impairments of one direction of the link. Times in seconds, probabilities in [0, 1], rate in kbit/s (0 = unlimited)
+    def __init__(self, delay=0.0, jitter=0.0, jitter_dist="uniform", loss=0.0, duplicate=0.0, reorder=0.0, rate=0.0, queue=0.1, rng=None):
+        self.delay = delay
+        self.jitter = jitter
+        self.jitter_dist = jitter_dist # uniform (+-jitter), normal (std jitter) or pareto (heavy tail with mean jitter)
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder # probability that a packet skips the delay and overtakes the queued ones (like netem)
+        self.rate = rate
+        self.queue = queue # packets that would wait longer than this for the rate limit are dropped
+        self.rng = rng if rng is not None else random.Random()
+        self.link_free = 0.0 # time at which the rate limited link finishes sending the queued packets
+
+    def sample_jitter(self):
+        if self.jitter <= 0:
+            return 0.0
+        if self.jitter_dist == "normal":
+            return self.rng.gauss(0.0, self.jitter)
+        if self.jitter_dist == "pareto":
+            # Pareto with shape 3 has mean 1.5*scale, shifted so the added delay has mean `jitter`
+            return self.rng.paretovariate(3.0) * self.jitter / 1.5
+        return self.rng.uniform(-self.jitter, self.jitter)
+
+    def departures(self, now, size):
+        # Times at which a packet of `size` bytes arriving at `now` leaves the proxy. Empty if it is lost
+        if self.rng.random() < self.loss:
+            return []
+        start = now
+        if self.rate > 0:
+            start = max(now, self.link_free)
+            if start - now > self.queue:
+                return [] # queue overflow
+            self.link_free = start + size * 8 / (self.rate * 1e3)
+            start = self.link_free
+        if self.rng.random() < self.reorder:
+            depart = start
+        else:
+            depart = start + max(0.0, self.delay + self.sample_jitter())
+        times = [depart]
+        if self.rng.random() < self.duplicate:
+            times.append(depart + max(0.0, self.sample_jitter()))
+        return times
+
+
+class _RelayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, proxy, side):
+        self.proxy = proxy
+        self.side = side
+
+    def datagram_received(self, data, addr):
+        self.proxy.relay(self.side, data)
+
+    def error_received(self, exc):
+        pass
+
+
+class ImpairmentProxy:
+    # Relays the datagrams of both directions through an Impairment each:
+    # operator -> PROXY_OPERATOR_SIDE -> SUBMARINE_ADDR and submarine -> PROXY_SUBMARINE_SIDE -> OPERATOR_ADDR
+    def __init__(self, upstream, downstream):
+        self.upstream = upstream # operator -> submarine
+        self.downstream = downstream # submarine -> operator
+        self.loop = None
+        self.transports = {}
+        self.relayed = {"up": 0, "down": 0}
+        self.thread = None
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.transports["op"], _ = await self.loop.create_datagram_endpoint(lambda: _RelayProtocol(self, "op"), local_addr=PROXY_OPERATOR_SIDE)
+        self.transports["sub"], _ = await self.loop.create_datagram_endpoint(lambda: _RelayProtocol(self, "sub"), local_addr=PROXY_SUBMARINE_SIDE)
+
+    def relay(self, side, data):
+        now = self.loop.time()
+        if side == "op":
+            link, transport, dest, key = self.upstream, self.transports["sub"], SUBMARINE_ADDR, "up"
+        else:
+            link, transport, dest, key = self.downstream, self.transports["op"], OPERATOR_ADDR, "down"
+        for t in link.departures(now, len(data)):
+            self.loop.call_at(t, transport.sendto, data, dest)
+            self.relayed[key] += 1
+
+    def set_impairments(self, upstream, downstream):
+        # Swap the link configuration (from any thread)
+        def swap():
+            self.upstream = upstream
+            self.downstream = downstream
+        self.loop.call_soon_threadsafe(swap)
+
+    def run_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.open())
+        try:
+            loop.run_forever()
+        finally:
+            for transport in self.transports.values():
+                transport.close()
+            loop.close()
+
+    def start(self):
+        # Run the proxy in a background thread
+        self.thread = threading.Thread(target=self.run_forever, name="ImpairmentProxy", daemon=True)
+        self.thread.start()
+        while self.loop is None or len(self.transports) < 2:
+            time.sleep(0.01)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+
+
+class ScriptedOperator:
+    # Stand-in for RemoteOperator during benchmarks: plays a LissajousOperator over the network, so the force
+    # feedback (and its delay) affects the motion.
+    # Give each operator its own session and local_port 0 to load a submarine server (see submarine_server.py).
+    def __init__(self, submarine_port, rate=100, k=0.5, b=0.8, window_scale=3000, local_port=OPERATOR_ADDR[1], session=0):
+        self.latency = LatencyMonitor()
+        self.net = Endpoint(("127.0.0.1", local_port), ("127.0.0.1", submarine_port), timeout=5.0,
+                            on_receive=self.on_message, session=session)
+        self.period = 1.0 / rate
+        self.operator = LissajousOperator(k, b, window_scale)
+        self.first_force = None # perf_counter of the first force, the submarine rate is measured from there
+
+    def on_message(self, msg):
+        if msg.type == protocol.FORCE:
+            if self.first_force is None:
+                self.first_force = time.perf_counter()
+            self.latency.record(msg)
+
+    def run(self, timeout):
+        # Returns the result of the trial, or None if the submarine never answered
+        start = time.perf_counter()
+        frames = 0
+        metrics = None
+        next_time = start
+        while time.perf_counter() - start < timeout:
+            t = time.perf_counter() - start
+            fe = np.zeros(2)
+            msg = self.net.latest(protocol.FORCE)
+            if msg is not None:
+                fe = msg.payload[:2]
+            self.net.send(protocol.POSITION, *self.operator.position(t, fe))
+            frames += 1
+
+            msg = self.net.take(protocol.METRICS)
+            if msg is not None:
+                metrics = msg.payload
+                break
+            if self.net.lost:
+                break
+
+            next_time += self.period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        end = time.perf_counter()
+        duration = end - start
+        # Release the submarine from its exit screen. Sent a few times in case the link loses it
+        for _ in range(5):
+            self.net.send(protocol.PLAY_AGAIN, False)
+            time.sleep(0.05)
+        self.net.close()
+
+        if not self.net.connected() and metrics is None:
+            return None
+        loss = self.net.channel.loss(protocol.FORCE)
+        forces = self.net.channel.received.get(protocol.FORCE, 0) + self.net.channel.lost.get(protocol.FORCE, 0)
+        # Without the start up of the submarine process, which takes a good part of short runs
+        connected = end - self.first_force if self.first_force is not None else duration
+        rtt = self.latency.rtt.percentiles() * 1e3
+        result = {
+            "operator_rate": frames / duration,
+            "submarine_rate": forces / connected if connected > 0 else 0.0,
+            "rtt_p50_ms": rtt[0], "rtt_p95_ms": rtt[1], "rtt_p99_ms": rtt[2],
+            "rtt_jitter_ms": self.latency.jitter_avg * 1e3,
+            "force_loss": loss,
+        }
+        if metrics is not None:
+            passed, final_time, path_length, damage = metrics
+            result.update({"passed": passed, "time": final_time, "path_length": path_length, "damage": damage})
+        return result
+
+
+def _run_submarine(render_haptics, max_time):
+    # Submarine process of a benchmark trial. Results are reported through the METRICS message, not results.txt
+    from submarine import Submarine, EndGame
+    submarine = Submarine(render_haptics, operator_port=PROXY_SUBMARINE_SIDE[1], max_time=max_time, results_file=None)
+    try:
+        while True:
+            submarine.run()
+    except EndGame as e:
+        submarine.close(e.error_code == 0)
+
+
+def make_link(args, delay, jitter, loss, duplicate, reorder, rate, rng):
+    return Impairment(delay / 1e3, jitter / 1e3, args.jitter_dist, loss, duplicate, reorder, rate, args.queue / 1e3, rng)
+
+
+def relay(args):
+    rng = random.Random(args.seed)
+    params = (args.delay[0], args.jitter[0], args.loss[0], args.duplicate[0], args.reorder[0], args.rate[0])
+    proxy = ImpairmentProxy(make_link(args, *params, rng), make_link(args, *params, rng))
+    print(f"Relaying operator -> {PROXY_OPERATOR_SIDE[1]} -> {SUBMARINE_ADDR[1]} and submarine -> {PROXY_SUBMARINE_SIDE[1]} -> {OPERATOR_ADDR[1]}")
+    print("delay {} ms, jitter {} ms ({}), loss {}, duplicate {}, reorder {}, rate {} kbit/s".format(*params[:2], args.jitter_dist, *params[2:]))
+    try:
+        proxy.run_forever()
+    except KeyboardInterrupt:
+        print(f"Relayed {proxy.relayed['up']} datagrams to the submarine and {proxy.relayed['down']} to the operator")
+
+
+def bench(args):
+    if not args.show:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    rng = random.Random(args.seed)
+    proxy = ImpairmentProxy(Impairment(), Impairment())
+    proxy.start()
+
+    fields = ["delay_ms", "jitter_ms", "jitter_dist", "loss", "duplicate", "reorder", "rate_kbps",
+              "operator_rate", "submarine_rate", "rtt_p50_ms", "rtt_p95_ms", "rtt_p99_ms", "rtt_jitter_ms", "force_loss",
+              "passed", "time", "path_length", "damage"]
+    # The submarine runs pygame in its own process, spawned so it does not inherit the proxy thread
+    context = multiprocessing.get_context("spawn")
+    with open(args.out, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        for params in itertools.product(args.delay, args.jitter, args.loss, args.duplicate, args.reorder, args.rate):
+            delay, jitter, loss, duplicate, reorder, rate = params
+            proxy.set_impairments(make_link(args, *params, rng), make_link(args, *params, rng))
+            for trial in range(args.repeat):
+                print(f"delay {delay} ms, jitter {jitter} ms, loss {loss}, duplicate {duplicate}, reorder {reorder}, rate {rate} kbit/s, trial {trial + 1}/{args.repeat}")
+                submarine = context.Process(target=_run_submarine, args=(not args.no_haptics, args.duration))
+                submarine.start()
+                operator = ScriptedOperator(PROXY_OPERATOR_SIDE[1])
+                result = operator.run(timeout=args.duration + 10)
+                submarine.join(timeout=70)
+                if submarine.is_alive():
+                    submarine.terminate()
+                if result is None:
+                    print("  no answer from the submarine")
+                    continue
+                row = {"delay_ms": delay, "jitter_ms": jitter, "jitter_dist": args.jitter_dist, "loss": loss,
+                       "duplicate": duplicate, "reorder": reorder, "rate_kbps": rate}
+                row.update(result)
+                writer.writerow(row)
+                file.flush()
+                print("  " + ", ".join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}" for k, v in result.items()))
+    proxy.stop()
+    print(f"Benchmark results saved to {args.out}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP impairment proxy between the operator and the submarine")
+    parser.add_argument("mode", choices=["relay", "bench"])
+    # In relay mode only the first value of each list is used, in bench mode every combination is run
+    parser.add_argument("--delay", type=float, nargs="+", default=[0.0], help="one-way delay in ms")
+    parser.add_argument("--jitter", type=float, nargs="+", default=[0.0], help="jitter in ms")
+    parser.add_argument("--jitter-dist", choices=["uniform", "normal", "pareto"], default="uniform")
+    parser.add_argument("--loss", type=float, nargs="+", default=[0.0], help="packet loss probability")
+    parser.add_argument("--duplicate", type=float, nargs="+", default=[0.0], help="packet duplication probability")
+    parser.add_argument("--reorder", type=float, nargs="+", default=[0.0], help="probability that a packet skips the delay")
+    parser.add_argument("--rate", type=float, nargs="+", default=[0.0], help="bandwidth cap in kbit/s, 0 for unlimited")
+    parser.add_argument("--queue", type=float, default=100.0, help="max queueing delay of the bandwidth cap in ms")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=20.0, help="bench: length of a trial in s")
+    parser.add_argument("--repeat", type=int, default=1, help="bench: trials per combination")
+    parser.add_argument("--no-haptics", action="store_true", help="bench: submarine sends zero forces")
+    parser.add_argument("--show", action="store_true", help="bench: show the submarine window")
+    parser.add_argument("--out", default="bench_results.csv", help="bench: output file")
+    args = parser.parse_args()
+
+    if args.mode == "relay":
+        relay(args)
+    else:
+        bench(args)
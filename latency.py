@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+
+
+class RingBuffer:
+    # Fixed-size buffer of the last `size` samples, old samples are overwritten
+    def __init__(self, size):
+        self.data = np.zeros(size)
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.count % len(self.data)] = value
+        self.count += 1
+
+    def values(self):
+        # Samples currently in the buffer (not in time order)
+        return self.data[:min(self.count, len(self.data))]
+
+    def percentiles(self, q=(50, 95, 99)):
+        values = self.values()
+        if len(values) == 0:
+            return np.zeros(len(q))
+        return np.percentile(values, q)
+
+
+class LatencyMonitor:
+    # Round-trip statistics of the position -> force loop, measured on the operator.
+    # Every force reply echoes the sequence number and send time of the position it was computed from,
+    # and how long the submarine held that position before answering.
+    def __init__(self, size=1000, bin_ms=0.5, max_ms=500):
+        self.rtt = RingBuffer(size) # seconds from sending a position to receiving its force
+        self.one_way = RingBuffer(size) # (rtt - submarine hold time) / 2
+        self.jitter = RingBuffer(size) # |difference between consecutive rtt samples|
+        self.jitter_avg = 0.0 # smoothed jitter as in RFC 3550
+        self.prev_rtt = None
+        self.last_echo = None
+
+        # Session histograms with fixed bins, the last bin also counts everything above max_ms
+        self.bin_ms = bin_ms
+        self.hist = {name: np.zeros(int(max_ms / bin_ms) + 1, dtype=np.int64) for name in ("rtt", "one_way", "jitter")}
+
+    def record(self, msg):
+        # Called with every FORCE message accepted by the operator (network thread)
+        echo_seq, echo_stamp, hold = msg.payload[2:]
+        # The submarine answers every frame with the newest position it has, only the first answer is a round trip
+        if echo_seq == self.last_echo:
+            return
+        self.last_echo = echo_seq
+
+        rtt = msg.recv_time - echo_stamp
+        one_way = max(0.0, (rtt - hold) / 2)
+        self.rtt.append(rtt)
+        self.one_way.append(one_way)
+        self.add_to_hist("rtt", rtt)
+        self.add_to_hist("one_way", one_way)
+        if self.prev_rtt is not None:
+            d = abs(rtt - self.prev_rtt)
+            self.jitter.append(d)
+            self.add_to_hist("jitter", d)
+            self.jitter_avg += (d - self.jitter_avg) / 16
+        self.prev_rtt = rtt
+
+    def add_to_hist(self, name, value):
+        hist = self.hist[name]
+        hist[min(int(value * 1e3 / self.bin_ms), len(hist) - 1)] += 1
+
+    def reset_peer(self):
+        # The submarine restarted (new game) so its echoes start over
+        self.last_echo = None
+        self.prev_rtt = None
+
+    def summary(self, loss=0.0):
+        # One line for the debug overlay, times in ms
+        rtt = self.rtt.percentiles() * 1e3
+        ow = self.one_way.percentiles() * 1e3
+        return (f"RTT p50/95/99: {rtt[0]:.1f}/{rtt[1]:.1f}/{rtt[2]:.1f} "
+                f"1-way p50: {ow[0]:.1f} jitter: {self.jitter_avg*1e3:.2f} loss: {loss*100:.1f}%")
+
+    def save_histogram(self, filename=None, loss=0.0):
+        # Write the rtt, one-way and jitter histograms of the session (ms bins) with a summary header.
+        # Empty bins after the last sample are not written
+        if self.rtt.count == 0:
+            return None
+        if filename is None:
+            filename = f"latency_{time.strftime('%Y%m%d_%H%M%S', time.localtime())}.csv"
+        rtt, ow, jit = self.hist["rtt"], self.hist["one_way"], self.hist["jitter"]
+        used = np.nonzero(rtt + ow + jit)[0]
+        last = used[-1] + 1 if len(used) > 0 else 0
+        p = self.rtt.percentiles() * 1e3
+        with open(filename, "w") as file:
+            file.write(f"# samples: {self.rtt.count}, last {len(self.rtt.values())} rtt p50: {p[0]:.3f} ms, p95: {p[1]:.3f} ms, "
+                       f"p99: {p[2]:.3f} ms, jitter: {self.jitter_avg*1e3:.3f} ms, loss: {loss*100:.2f}%\n")
+            file.write("bin_start_ms,bin_end_ms,rtt,one_way,jitter\n")
+            for i in range(last):
+                end = f"{(i+1)*self.bin_ms:.1f}" if i < len(rtt) - 1 else "inf"
+                file.write(f"{i*self.bin_ms:.1f},{end},{rtt[i]},{ow[i]},{jit[i]}\n")
+        return filename
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import pygame
+
+
+class Layer:
+    # Static part of the scene drawn once into its own surface by draw(surface) and blitted every frame until
+    # invalidate() is called (e.g. when the scene changes).
+    #   areas: rects the layer covers, only they are blitted so the layer can be drawn above dynamic elements
+    #   without transparency. None for the whole surface. Invalidate the layer if they move
+    def __init__(self, size, draw, areas=None):
+        self.size = size
+        self.draw = draw
+        self.areas = areas
+        self.surface = None
+
+    def invalidate(self):
+        self.surface = None
+
+    def get(self):
+        if self.surface is None:
+            surface = pygame.Surface(self.size)
+            self.draw(surface)
+            # Same pixel format as the window, so blits are plain copies
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert()
+            self.surface = surface
+        return self.surface
+
+    def blit(self, target, areas=None):
+        # areas: only blit these rects instead of the areas of the layer
+        surface = self.get()
+        if areas is None:
+            areas = self.areas
+        if areas is None:
+            target.blit(surface, (0, 0))
+        else:
+            target.blits([(surface, area, area) for area in areas], doreturn=False)
+
+
+class DirtyRects:
+    # Regions of the window that change from one frame to the next. Every element drawn in a frame adds the rect it
+    # covers, present() copies the rects of this frame and of the previous one (where the elements were) from the
+    # scene surface to the window and updates only them. When they cover more than `full` of the window, or after
+    # invalidate() (something else drew on the window), the whole window is flipped instead.
+    def __init__(self, size, full=0.5):
+        self.screen = pygame.Rect((0, 0), size)
+        self.full = full
+        self.previous = None # rects of the last frame, None for the whole window
+        self.current = []
+
+    def add(self, rect):
+        self.current.append(rect)
+        return rect
+
+    def invalidate(self):
+        self.previous = None
+
+    def present(self, window, surface, enabled=True):
+        rects = None
+        if enabled and self.previous is not None:
+            rects = [r.clip(self.screen) for r in self.previous + self.current]
+            rects = [r for r in rects if r.width and r.height]
+            if sum(r.width * r.height for r in rects) > self.full * self.screen.width * self.screen.height:
+                rects = None
+        if rects is None:
+            window.blit(surface, (0, 0))
+            pygame.display.flip()
+        else:
+            window.blits([(surface, r, r) for r in rects], doreturn=False)
+            pygame.display.update(rects)
+        self.previous = self.current
+        self.current = []
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+
+import protocol
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, udp):
+        self.udp = udp
+
+    def datagram_received(self, data, addr):
+        self.udp.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable while the peer is not running yet) are not fatal for UDP
+        pass
+
+
+class UdpThread:
+    # UDP socket served by an asyncio event loop in a background thread.
+    # on_datagram(data, addr) is called from that thread for every datagram, on_tick() every `tick` seconds.
+    def __init__(self, local_addr, on_datagram, on_tick=None, tick=0.1):
+        self.local_addr = local_addr
+        self.on_datagram = on_datagram
+        self.on_tick = on_tick
+        self.tick = tick
+
+        self.loop = asyncio.new_event_loop()
+        self.transport = None
+        self.error = None
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), name="Network", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), local_addr=self.local_addr))
+        except OSError as e:
+            self.error = e
+            ready.set()
+            return
+        watchdog = self.loop.create_task(self._watchdog())
+        ready.set()
+        self.loop.run_forever()
+
+        # Loop stopped by close()
+        watchdog.cancel()
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0)) # let the transport and the watchdog finish
+        self.loop.close()
+
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            if self.on_tick is not None:
+                self.on_tick()
+
+    def sendto(self, data, addr):
+        # Can be called from any thread
+        self.loop.call_soon_threadsafe(self.transport.sendto, data, addr)
+
+    def close(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1.0)
+
+
+class Link:
+    # Connection with one peer: decodes its datagrams, keeps only the newest message of each type,
+    # so the frame loop can read them without ever blocking on a socket, and flags the connection as lost
+    # when nothing arrives for `timeout` seconds.
+    # transmit(data) sends a datagram to the peer. on_receive, if given, is called from the network thread
+    # with every accepted message.
+    def __init__(self, transmit, session=0, timeout=1.0, on_receive=None):
+        self.transmit = transmit
+        self.timeout = timeout
+        self.on_receive = on_receive
+        self.channel = protocol.Channel(session)
+
+        self.messages = {} # newest message of each type
+        self.last_rx = None # perf_counter of the last valid datagram, None until the peer is connected
+        self.lost = False # set by check_timeout
+
+    def deliver(self, data):
+        # Runs in the network thread
+        msg = self.channel.accept(data)
+        if msg is not None:
+            self.messages[msg.type] = msg
+            self.last_rx = time.perf_counter()
+            if self.on_receive is not None:
+                self.on_receive(msg)
+
+    def check_timeout(self):
+        if self.last_rx is not None and time.perf_counter() - self.last_rx > self.timeout:
+            self.lost = True
+
+    def send(self, msg_type, *values):
+        # Encode in the caller thread so the timestamp is the real send time, transmit from the network thread.
+        # Returns the sequence number of the message
+        seq = self.channel.tx_seq.get(msg_type, 0)
+        self.transmit(self.channel.encode(msg_type, *values))
+        return seq
+
+    def latest(self, msg_type):
+        # Newest message of the given type, or None. The message is kept for later calls
+        return self.messages.get(msg_type)
+
+    def take(self, msg_type):
+        # Newest message of the given type, or None. The message is removed so it is only handled once
+        return self.messages.pop(msg_type, None)
+
+    def connected(self):
+        return self.last_rx is not None
+
+    def reset(self):
+        # Forget the peer (e.g. it restarts for a new game). The watchdog is disarmed until it sends again
+        self.last_rx = None
+        self.lost = False
+        self.messages = {}
+        self.channel.reset_rx()
+
+    def close(self):
+        pass
+
+
+class Endpoint(Link):
+    # Link with its own UDP socket, talking to a single peer. Connection loss is checked by a separate
+    # watchdog task of the network thread.
+    def __init__(self, local_addr, peer_addr, timeout=1.0, on_receive=None, session=0):
+        super().__init__(self._transmit, session, timeout, on_receive)
+        self.local_addr = local_addr
+        self.peer_addr = peer_addr
+        self.udp = UdpThread(local_addr, lambda data, addr: self.deliver(data), self.check_timeout, timeout / 10)
+
+    def _transmit(self, data):
+        self.udp.sendto(data, self.peer_addr)
+
+    def close(self):
+        self.udp.close()
+
+
+class Server:
+    # One UDP socket shared by many sessions. Datagrams are dispatched to a Link per session ID and the
+    # replies go back to the address the session last sent from. New sessions are queued in `new_sessions`
+    # for the caller to pick up, up to max_sessions at the same time.
+    def __init__(self, local_addr, timeout=1.0, max_sessions=16):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.sessions = {} # session ID -> Link
+        self.peers = {} # session ID -> address
+        self.lock = threading.Lock() # sessions and peers are changed by the network thread and by remove()
+        self.new_sessions = [] # session IDs created by the network thread
+        self.refused = 0
+        self.udp = UdpThread(local_addr, self.dispatch, self.check_timeouts, timeout / 10)
+
+    def dispatch(self, data, addr):
+        # Runs in the network thread
+        session = protocol.session_of(data)
+        if session is None:
+            return
+        with self.lock:
+            link = self.sessions.get(session)
+            if link is None:
+                # Only an operator that is starting or playing opens a session, not late messages of a finished one
+                if data[1] not in (protocol.HELLO, protocol.POSITION):
+                    return
+                if len(self.sessions) >= self.max_sessions:
+                    self.refused += 1
+                    return
+                link = Link(lambda data, session=session: self.send_to(session, data), session, self.timeout)
+                self.sessions[session] = link
+                self.new_sessions.append(session)
+            self.peers[session] = addr
+        link.deliver(data)
+
+    def send_to(self, session, data):
+        # Replies of a session that was removed are dropped
+        addr = self.peers.get(session)
+        if addr is not None:
+            self.udp.sendto(data, addr)
+
+    def check_timeouts(self):
+        for link in list(self.sessions.values()):
+            link.check_timeout()
+
+    def remove(self, session):
+        # Forget a finished session. If the operator keeps sending it will be created again
+        with self.lock:
+            self.sessions.pop(session, None)
+            self.peers.pop(session, None)
+
+    def close(self):
+        self.udp.close()
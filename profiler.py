@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import time
+
+import numpy as np
+
+from latency import RingBuffer
+
+
+class Profiler:
+    # Time spent in each stage of the loop, to tell what makes a frame late:
+    #
+    #   with profiler.stage("render"):
+    #       ...
+    #
+    # or @profiler.timed("name") on a function. Stages can be nested, the time of the inner stages is not counted in
+    # the outer one, so the stages of a frame add up to the frame time (but for what runs outside of any stage).
+    # frame() closes a loop iteration: its stage times become a row of the session CSV written by save().
+    # The overlay shows the rolling min/mean/p99 of the last `size` runs of each stage, refreshed every
+    # `refresh` s. When disabled stage() returns a shared no-op context and nothing is recorded.
+    def __init__(self, enabled=False, size=500, refresh=0.25):
+        self.enabled = enabled
+        self.size = size
+        self.refresh = refresh
+        self.times = {} # stage -> RingBuffer of the last run times (s)
+        self.current = {} # stage -> time spent in this frame (s)
+        self.rows = [] # (frame start, {stage: time}) of the session
+        self.frame_start = None
+        self.active = None # innermost running stage
+        self.overlay_lines = []
+        self.overlay_time = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.current = {}
+        self.frame_start = None
+        self.active = None
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def timed(self, name):
+        def decorator(function):
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, seconds):
+        buffer = self.times.get(name)
+        if buffer is None:
+            buffer = self.times[name] = RingBuffer(self.size)
+        buffer.append(seconds)
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.add("frame", now - self.frame_start)
+            self.rows.append((self.frame_start, self.current))
+        self.current = {}
+        self.frame_start = now
+
+    def stats(self, name):
+        # Rolling min, mean and p99 of a stage (s)
+        values = self.times[name].values()
+        return values.min(), values.mean(), np.percentile(values, 99)
+
+    def overlay(self):
+        # Lines of the overlay, times in ms
+        now = time.perf_counter()
+        if self.overlay_time is None or now - self.overlay_time >= self.refresh:
+            self.overlay_time = now
+            self.overlay_lines = ["stage  min/mean/p99 ms"]
+            for name in self.times:
+                low, mean, p99 = np.array(self.stats(name)) * 1e3
+                self.overlay_lines.append(f"{name}: {low:.2f}/{mean:.2f}/{p99:.2f}")
+        return self.overlay_lines
+
+    def save(self, filename=None, prefix="profile"):
+        # Write the stage times of every frame of the session (ms), empty where a stage did not run
+        if not self.rows:
+            return None
+        if filename is None:
+            filename = f"{prefix}_{time.strftime('%Y%m%d_%H%M%S', time.localtime())}.csv"
+        names = ["frame"] + [name for name in self.times if name != "frame"]
+        start = self.rows[0][0]
+        with open(filename, "w") as file:
+            file.write(",".join(["time_s"] + names) + "\n")
+            for t, stages in self.rows:
+                cells = [f"{t - start:.6f}"] + [f"{stages[name] * 1e3:.3f}" if name in stages else "" for name in names]
+                file.write(",".join(cells) + "\n")
+        self.rows = []
+        return filename
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.inner = 0.0 # time of the nested stages
+        self.parent = self.profiler.active
+        self.profiler.active = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.profiler.active = self.parent
+        if self.parent is not None:
+            self.parent.inner += elapsed
+        self.profiler.add(self.name, elapsed - self.inner)
+        return False
+
+
+_NO_STAGE = contextlib.nullcontext()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import struct
+import time
+
+# Wire protocol shared by the operator and the submarine.
+# Every datagram is a fixed header followed by a payload whose layout depends on the message type.
+# Header: version (uint8), message type (uint8), session ID (uint16), sequence number (uint32), send timestamp (float64, time.time())
+VERSION = 4
+HEADER = struct.Struct("!BBHId")
+
+# Message types
+HELLO = 0       # both ways: sent while waiting for the peer, opens the session on a submarine server
+POSITION = 1    # operator -> submarine: haptic position (x,y), submarine position (x,y), grab flag
+FORCE = 2       # submarine -> operator: force feedback (fx,fy), echo of the position it answers (seq, send timestamp) and how long the submarine held it
+METRICS = 3     # submarine -> operator: passed, final time, path length, damage. Also means game over
+DROP = 4        # submarine -> operator: object dropped, reset the grab flag
+PLAY_AGAIN = 5  # operator -> submarine: play again or not
+MODEL = 6       # submarine -> operator: parameters of the scene model for model-mediated teleoperation (see scene_model.py)
+
+PAYLOADS = {
+    HELLO: struct.Struct("!"),
+    POSITION: struct.Struct("!dddd?"),
+    FORCE: struct.Struct("!ffIdf"),
+    METRICS: struct.Struct("!?fff"),
+    DROP: struct.Struct("!"),
+    PLAY_AGAIN: struct.Struct("!?"),
+    # haptics, mass, water density, gravity, cross sectional area, displaced volume, water damping, net weight of the grabbed object (N), wall and platform rects
+    MODEL: struct.Struct("!?7f8h"),
+}
+
+# Largest datagram we can receive
+MAX_SIZE = HEADER.size + max(p.size for p in PAYLOADS.values())
+
+SEQ_MOD = 1 << 32
+
+
+class ProtocolError(Exception):
+    """Raised when a datagram cannot be decoded."""
+    pass
+
+
+class Message:
+    def __init__(self, msg_type, session, seq, stamp, payload):
+        self.type = msg_type
+        self.session = session # identifies the operator in a multi-session submarine server
+        self.seq = seq
+        self.stamp = stamp # send time in seconds (time.time() of the sender)
+        self.payload = payload
+        self.recv_time = None # set when the message is accepted by a Channel
+
+    def age(self, now=None):
+        # Time in seconds since the message was sent. Both ends run on the same clock (same machine)
+        if now is None:
+            now = time.time()
+        return now - self.stamp
+
+    def __repr__(self):
+        return f"Message(type={self.type}, seq={self.seq}, age={self.age()*1e3:.2f}ms, payload={self.payload})"
+
+
+def encode(msg_type, seq, *values, stamp=None, session=0):
+    # Build a datagram for the given message type and payload values
+    if stamp is None:
+        stamp = time.time()
+    return HEADER.pack(VERSION, msg_type, session, seq % SEQ_MOD, stamp) + PAYLOADS[msg_type].pack(*values)
+
+
+def decode(data):
+    # Parse a datagram into a Message, raise ProtocolError if it is malformed or from another version
+    if len(data) < HEADER.size:
+        raise ProtocolError(f"Datagram too short ({len(data)} bytes)")
+    version, msg_type, session, seq, stamp = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if msg_type not in PAYLOADS:
+        raise ProtocolError(f"Unknown message type {msg_type}")
+    payload = PAYLOADS[msg_type]
+    if len(data) != HEADER.size + payload.size:
+        raise ProtocolError(f"Wrong payload size for message type {msg_type}")
+    return Message(msg_type, session, seq, stamp, payload.unpack_from(data, HEADER.size))
+
+
+def session_of(data):
+    # Session ID of a datagram without decoding the payload, None if it is not one of ours
+    if len(data) < HEADER.size or data[0] != VERSION:
+        return None
+    return HEADER.unpack_from(data)[2]
+
+
+def seq_newer(seq, last):
+    # True if seq comes after last, taking the 32 bit wrap around into account
+    return 0 < (seq - last) % SEQ_MOD < SEQ_MOD // 2
+
+
+class Channel:
+    # Keeps the outgoing sequence numbers and filters the incoming messages of one endpoint.
+    # Sequence numbers are counted per message type, so a message is only dropped when a newer one of the same type was already accepted.
+    # Outgoing messages are tagged with `session`.
+    def __init__(self, session=0):
+        self.session = session
+        self.tx_seq = {}
+        self.rx_seq = {}
+        self.dropped = 0 # stale, reordered, duplicated or malformed datagrams
+        self.received = {} # accepted messages per type
+        self.lost = {} # messages per type that never arrived, from the gaps in the sequence numbers
+
+    def encode(self, msg_type, *values):
+        seq = self.tx_seq.get(msg_type, 0)
+        self.tx_seq[msg_type] = (seq + 1) % SEQ_MOD
+        return encode(msg_type, seq, *values, session=self.session)
+
+    def accept(self, data):
+        # Decode a datagram, return None if it is invalid or older than the last accepted one of its type
+        try:
+            msg = decode(data)
+        except ProtocolError:
+            self.dropped += 1
+            return None
+        last = self.rx_seq.get(msg.type)
+        if last is not None:
+            if not seq_newer(msg.seq, last):
+                self.dropped += 1
+                return None
+            self.lost[msg.type] = self.lost.get(msg.type, 0) + (msg.seq - last) % SEQ_MOD - 1
+        self.rx_seq[msg.type] = msg.seq
+        self.received[msg.type] = self.received.get(msg.type, 0) + 1
+        msg.recv_time = time.time()
+        return msg
+
+    def loss(self, msg_type):
+        # Fraction of the messages of the given type that were lost
+        lost = self.lost.get(msg_type, 0)
+        total = lost + self.received.get(msg_type, 0)
+        return lost / total if total > 0 else 0.0
+
+    def reset_rx(self):
+        # Forget the peer sequence numbers, used when the peer restarts (new game)
+        self.rx_seq = {}
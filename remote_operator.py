@@ -2,29 +2,58 @@
 import sys
 import numpy as np
 import pygame
-import socket
+import random
+import threading
+import time
 import traceback
 
+import protocol
+from network import Endpoint
+from latency import LatencyMonitor
+from scene_model import SceneModel
 from Physics import Physics
+from device_servo import DeviceServo
 from Graphics_operator import Graphics
 from submarine import EndGame
 
 class RemoteOperator:
-    def __init__(self):
+    def __init__(self, device_rate=1000, submarine_port=40002, model_mediated=False, local_port=40001, session=None):
         self.physics = Physics(hardware_version=3) #setup physics class. Returns a boolean indicating if a device is connected
         self.device_connected = self.physics.is_device_connected() #returns True if a connected haply device was found
         self.graphics = Graphics(self.device_connected) #setup class for drawing and graphics.
-        
-        # Set up socket for UDP communication 
-        self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.recv_sock.bind(("127.0.0.1", 40001))
-        self.recv_sock.setblocking(False)
-        self.grab_object= 0
 
         # Submarine initial position
         self.xs = np.array([320, 10], dtype=np.float64) 
 
+        # The haptic device runs in its own thread at device_rate Hz, the render/network loop stays at 100 Hz
+        self.servo = None
+        if self.device_connected:
+            self.servo = DeviceServo(self.physics, rate=device_rate)
+            self.servo.start()
+
+        # Model-mediated teleoperation: forces of a local replica of the scene are rendered without network delay,
+        # the submarine forces only correct it. 'l' toggles it
+        self.model = SceneModel()
+        # The model and the correction are used by the servo thread (local_force), the network thread (on_message)
+        # and this one, every access holds the lock. Reentrant, a reset calls set_model_mediated
+        self.model_lock = threading.RLock()
+        self.correction = np.zeros(2) # filtered difference between the submarine force and the local prediction
+        self.correction_gain = 0.2
+        self.predicted = {} # local force at the time each position was sent, by sequence number
+        self.set_model_mediated(model_mediated)
+        
+        # Set up UDP communication. The connection is considered lost after 1 s without messages from the submarine
+        self.latency = LatencyMonitor()
+        # submarine_port can point to an impairment proxy instead of the submarine (see impairment_proxy.py)
+        # A submarine server tells the operators apart by the session ID, local_port 0 picks any free port
+        if session is None:
+            session = random.randrange(1, 1 << 16)
+        self.session = session
+        self.net = Endpoint(("127.0.0.1", local_port), ("127.0.0.1", submarine_port), timeout=1.0,
+                            on_receive=self.on_message, session=session)
+        self.force_age = 0 # seconds since the last force message was sent by the submarine
+        self.grab_object= 0
+
         # Wait for user to press the space bar
         self.graphics.show_loading_screen()
         run = True
@@ -35,31 +64,60 @@ class RemoteOperator:
                     run = False 
 
         # Wait for at least one message from the master. Only continue once something is received.
-        print("Waiting for submarine communication")
+        print(f"Waiting for submarine communication (session {self.session})")
         i = 0
-        while True:
-            try: 
-                _= self.recv_sock.recvfrom(1024)
-                print("Connected")
-                # Set a timeout to allow closing the window automatically when the communication is broken
-                self.recv_sock.settimeout(1)
-                break
-            except BlockingIOError:
-                self.graphics.show_loading_screen(True, i)
-                i += 1
+        last_hello = 0
+        while not self.net.connected():
+            # Announce the session every 10 ms so a submarine server can start it
+            if time.time() - last_hello > 0.01:
+                self.net.send(protocol.HELLO)
+                last_hello = time.time()
+            self.graphics.show_loading_screen(True, i)
+            i += 1
+        print("Connected")
             
         ##############################################
+
+    def on_message(self, msg):
+        # Called from the network thread for every accepted message
+        if msg.type == protocol.FORCE:
+            self.latency.record(msg)
+            # Compare the submarine force with what the local model predicted for the same position
+            with self.model_lock:
+                predicted = self.predicted.pop(msg.payload[2], None)
+                if predicted is not None:
+                    error = np.array(msg.payload[:2]) - predicted
+                    self.correction = self.correction + self.correction_gain * (error - self.correction)
+        elif msg.type == protocol.MODEL:
+            with self.model_lock:
+                self.model.update(msg.payload)
+
+    def set_model_mediated(self, enabled):
+        with self.model_lock:
+            self.model_mediated = enabled
+            self.correction = np.zeros(2)
+            self.predicted = {}
+        if self.servo is not None:
+            self.servo.force_model = self.local_force if enabled else None
+
+    def local_force(self, pE):
+        # Local scene model force at the device endpoint, called by the servo thread at device rate
+        xh = self.graphics.convert_pos(pE)
+        with self.model_lock:
+            return self.model.force(xh, self.xs, time.perf_counter()) * [1, 0.5]
     
     def run(self):
         p = self.physics #assign these to shorthand variables for easier use in this function
         g = self.graphics
+        g.profiler.frame() #stage times of the loop, 'p' toggles them (see profiler.py)
         #get input events for both keyboard and mouse
-        keyups, xm, keypressed, keydowns = g.get_events()
+        with g.profiler.stage("events"):
+            keyups, xm, keypressed, keydowns = g.get_events()
         #  - keyups: list of unicode numbers for keys on the keyboard that were released this cycle
         #  - pm: coordinates of the mouse on the graphics screen this cycle (x,y)      
         #get the state of the device, or otherwise simulate it if no device is connected (using the mouse position)
         if self.device_connected:
-            pA0,pB0,pA,pB,pE = p.get_device_pos() #positions of the various points of the pantograph
+            pA0,pB0,pA,pB,pE = self.servo.position.get() #newest positions of the various points of the pantograph
             pA0,pB0,pA,pB,xh = g.convert_pos(pA0,pB0,pA,pB,pE) #convert the physical positions to screen coordinates
         else:
             xh = g.haptic.center
@@ -81,6 +139,10 @@ class RemoteOperator:
                 g.show_linkages = not g.show_linkages
             if key == ord('d'): #Change the visibility of the debug text
                 g.show_debug = not g.show_debug
+            if key == ord('l'): #Toggle the local scene model (model-mediated teleoperation)
+                self.set_model_mediated(not self.model_mediated)
+            if key == ord('p'): #Toggle the profiler overlay, the stage times are saved on close
+                g.profiler.toggle()
             if key == pygame.K_SPACE: # Space bar pressed for grabbing object
                 if (self.grab_object == 0):
                     self.grab_object = 1
@@ -93,82 +155,124 @@ class RemoteOperator:
         if keypressed[pygame.K_RIGHT]:
             self.xs[0] = np.clip(self.xs[0] + 1, 0, 800 - 150)
 
-        # Send Position from the haptic device or mouse and the submarine position
-        message = np.array([xh, self.xs,(self.grab_object,0)])
-        self.send_sock.sendto(message.tobytes(), ("127.0.0.1", 40002))
-
-        # Receive Force feedback
-        last_message = np.array([0,0,0])
-        try:
-            while True:
-                try:
-                    # Empty buffer
-                    while True:  # Keep reading until the buffer is empty
-                        self.recv_sock.settimeout(0.01)
-                        recv_data, _ = self.recv_sock.recvfrom(1024)
-                        last_message = recv_data  # Store the latest message                        
-                except socket.timeout:
-                    self.recv_sock.settimeout(1)
-                    break  # Exit loop when no more data is available
-            # process the last message
-            rcv_msg = np.frombuffer(last_message, dtype=np.float32)
-            # is the first element is 0 it is a force message
-            if (int(rcv_msg[0]) == 0 ):
-                fe = np.array(rcv_msg[1:], dtype=np.float32)
-            # if the first element is a 1 is a metrics and game over message
-            elif (int(rcv_msg[0]) == 1 ):
-                passed, final_time, path_length, damage = rcv_msg[1:]
-                # Show game over screen with received metrics
-                play_again = self.graphics.show_exit_screen(passed, final_time, path_length, damage)
-                # send play again message to submarine
-                snd_msg = np.array([1500, play_again], dtype=int)
-                self.send_sock.sendto(snd_msg.tobytes(), ("127.0.0.1", 40002))
-
-                # if not play again end the operator
-                if not play_again:
-                    raise EndGame("Game Over", 2)
-                # if play again show the loading screen and wait for user input to start and reset submarine position
-                g.erase_screen()
-                g.show_loading_screen()
-                self.xs = np.array([320, 10], dtype=np.float64) 
-
-                run = True
-                while run:
-                    _, _, _, keydowns= self.graphics.get_events()
-                    for key in keydowns:
-                        if key== pygame.K_SPACE:
-                            run = False 
-            # If the first element is a 2 is a reset grab object message
-            elif (int(rcv_msg[0]) == 2 ):
-                self.grab_object = 0
-
-        # If there is a timeout the connection with the submarine has been lost
-        except socket.timeout:
+        # Local scene model force, with the device it is computed by the servo thread at device rate
+        if self.model_mediated and not self.device_connected:
+            with self.model_lock:
+                self.model.force(xh, self.xs, time.perf_counter())
+
+        # Send Position from the haptic device or mouse and the submarine position. The prediction is stored under
+        # the lock too, so the answer of the submarine cannot be handled before it
+        with g.profiler.stage("send"), self.model_lock:
+            seq = self.net.send(protocol.POSITION, xh[0], xh[1], self.xs[0], self.xs[1], bool(self.grab_object))
+            if self.model_mediated:
+                # Remember the prediction to correct the model when the submarine answers this position
+                self.predicted[seq] = self.model.last_force.copy()
+                self.predicted.pop(seq - 200, None)
+
+        # If nothing arrived for a while the connection with the submarine has been lost
+        if self.net.lost:
             raise EndGame("Connection lost", 1)
 
+        # Receive Force feedback. The network thread keeps the newest message of each type, so nothing blocks here
+        # Reset grab object message
+        if self.net.take(protocol.DROP) is not None:
+            self.grab_object = 0
+        # Force message, the last received force is held until a newer one arrives
+        msg = self.net.latest(protocol.FORCE)
+        if msg is not None:
+            self.force_age = msg.age()
+            fe = np.array(msg.payload[:2], dtype=np.float32)
+        if self.model_mediated:
+            # The submarine force only corrects the local model
+            with self.model_lock:
+                fe = self.model.last_force + self.correction
+        # Metrics and game over message
+        msg = self.net.take(protocol.METRICS)
+        if msg is not None:
+            passed, final_time, path_length, damage = msg.payload
+            fe = np.array([0.0,0.0])
+            # Show game over screen with received metrics
+            play_again = self.graphics.show_exit_screen(passed, final_time, path_length, damage)
+            # send play again message to submarine
+            self.net.send(protocol.PLAY_AGAIN, play_again)
+            # The next game is a new submarine that starts counting its messages from 0 again
+            self.net.reset()
+            self.latency.reset_peer()
+            with self.model_lock:
+                self.model.reset()
+                self.set_model_mediated(self.model_mediated)
+
+            # if not play again end the operator
+            if not play_again:
+                raise EndGame("Game Over", 2)
+            # if play again show the loading screen and wait for user input to start and reset submarine position
+            g.erase_screen()
+            g.show_loading_screen()
+            self.xs = np.array([320, 10], dtype=np.float64) 
+
+            run = True
+            while run:
+                _, _, _, keydowns= self.graphics.get_events()
+                for key in keydowns:
+                    if key== pygame.K_SPACE:
+                        run = False 
+
         # Update previous position
         self.prev_xh = xh.copy()
         # Sacale force in y for compatibility with the haptic device
         fe[1] = fe[1]*0.5
 
         ##############################################
-        if self.device_connected: #set forces only if the device is connected
-            p.update_force(fe)
+        if self.device_connected: #set forces only if the device is connected, the servo thread writes them to the device
+            if self.model_mediated:
+                with self.model_lock:
+                    correction = self.correction
+                self.servo.force.put(correction * [1, 0.5]) #the servo adds the local model force at device rate
+            else:
+                self.servo.force.put(fe)
         else:
-            xh = g.sim_forces(xh,fe,xm,mouse_k=0.5,mouse_b=0.8) #simulate forces with mouse haptics
-            pos_phys = g.inv_convert_pos(xh)
-            pA0,pB0,pA,pB,pE = p.derive_device_pos(pos_phys) #derive the pantograph joint positions given some endpoint position
-            pA0,pB0,pA,pB,xh = g.convert_pos(pA0,pB0,pA,pB,pE) #convert the physical positions to screen coordinates
-        g.render(pA0,pB0,pA,pB,xh,fe,xm)
+            with g.profiler.stage("sim_forces"):
+                xh = g.sim_forces(xh,fe,xm,mouse_k=0.5,mouse_b=0.8) #simulate forces with mouse haptics
+            with g.profiler.stage("derive_device_pos"):
+                pos_phys = g.inv_convert_pos(xh)
+                pA0,pB0,pA,pB,pE = p.derive_device_pos(pos_phys) #derive the pantograph joint positions given some endpoint position
+                pA0,pB0,pA,pB,xh = g.convert_pos(pA0,pB0,pA,pB,pE) #convert the physical positions to screen coordinates
+        with g.profiler.stage("render"):
+            if g.show_debug:
+                g.latency_text = self.latency.summary(self.net.channel.loss(protocol.FORCE))
+            g.render(pA0,pB0,pA,pB,xh,fe,xm)
         
     def close(self):
+        # Save the latency histogram of the session
+        filename = self.latency.save_histogram(loss=self.net.channel.loss(protocol.FORCE))
+        if filename is not None:
+            print(f"Latency histogram saved to {filename}")
+        filename = self.graphics.profiler.save(prefix="profile_operator")
+        if filename is not None:
+            print(f"Stage times saved to {filename}")
+        if self.servo is not None:
+            self.servo.stop()
         self.physics.close()
         self.graphics.close()
-        self.send_sock.close()
-        self.recv_sock.close()
+        self.net.close()
 
 if __name__=="__main__":
-    operator = RemoteOperator()
+    try:
+        submarine_port = int(sys.argv[1])
+    except:
+        # Default submarine port, use the proxy port to run through impairment_proxy.py
+        submarine_port = 40002
+    try:
+        model_mediated = sys.argv[2].lower() == "true"
+    except:
+        # Default to forces rendered by the submarine only
+        model_mediated = False
+    try:
+        local_port = int(sys.argv[3])
+    except:
+        # Default operator port, use 0 to run several operators against a submarine server
+        local_port = 40001
+    operator = RemoteOperator(submarine_port=submarine_port, model_mediated=model_mediated, local_port=local_port)
     try:
         while True:
             operator.run()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from forces import water_forces
+
+
+# Force of a wall contact as a function of how far the commanded position went into the wall (pixels)
+def force_wall(difference, k=0.2):
+    if (difference<50):
+        difference=50
+    elif (difference<60):
+        difference=100
+        k=0.3
+    elif (difference<70):
+        difference=150
+        k=0.4
+    elif(difference<90):
+        difference=500
+        k=0.8
+    elif(difference>=90):
+        difference=1000
+        k=1
+
+    return difference*k
+
+
+class SceneModel:
+    # Lightweight replica of the submarine scene kept by the operator (model-mediated teleoperation).
+    # It renders the forces that only depend on the operator position (buoyancy, hydrostatic pressure, water drag,
+    # net weight of the grabbed object and wall/platform contacts) without waiting for the network.
+    # The grabbed object hangs from a stiff damped spring on the submarine (see bodies.py), so at rest the gripper
+    # only feels its weight minus its buoyancy, the swinging of the spring is left to the correction.
+    # The submarine keeps it up to date with MODEL messages, everything it cannot predict (fish, currents and the
+    # model error) arrives as a correction computed from the FORCE replies.
+    def __init__(self, window_scale=3000, window_size=(800, 600)):
+        self.window_scale = window_scale
+        self.window_size = window_size
+
+        # Defaults match Submarine/Graphics_submarine until the first MODEL message arrives
+        self.haptics = False # no local forces before the submarine said haptics are enabled
+        self.mass = 0.5
+        self.water_density = 1025
+        self.gravity = 9.81
+        self.cross_sectional_area = (48 / window_scale) ** 2
+        self.displaced_volume = (48 / window_scale) ** 3
+        self.b_water = 0.5
+        self.object_weight = 0.0 # weight minus buoyancy of the grabbed object (N)
+        self.wall = (0, 300, 185, 600) # left, top, width, height in submarine pixels
+        self.platform = (600, 400, 800, 600)
+
+        # Gripper extents around its position used by the submarine contact checks
+        self.half_width = 20
+        self.bottom = 25
+
+        # Velocity/acceleration state
+        self.prev_xm = None
+        self.prev_t = None
+        self.v = np.zeros(2)
+        self.a = np.zeros(2)
+        self.tau = 0.01 # time constant of the velocity filter (s)
+        self.last_force = np.zeros(2)
+
+    def update(self, payload):
+        # Apply a MODEL message from the submarine
+        (self.haptics, self.mass, self.water_density, self.gravity, self.cross_sectional_area,
+         self.displaced_volume, self.b_water, self.object_weight) = payload[:8]
+        self.wall = tuple(payload[8:12])
+        self.platform = tuple(payload[12:16])
+
+    def to_submarine(self, xh, xs):
+        # Same mapping the submarine applies to the received operator position
+        xm = np.array([xh[0] + (xs[0] + 177) - self.window_size[0] / 2, xh[1] * 1.3], dtype=np.float64)
+        xm[0] = np.clip(xm[0], -100, self.window_size[0] + 100)
+        xm[1] = np.clip(xm[1], 0, self.window_size[1] + 75)
+        return xm
+
+    def contact_force(self, xm):
+        f = np.zeros(2)
+        # Platform on the right, touched from the top or from the left
+        left, top = self.platform[0], self.platform[1]
+        pen_x = xm[0] + self.half_width - left
+        pen_y = xm[1] + self.bottom - top
+        if pen_x > 0 and pen_y > 0:
+            if pen_x > pen_y:
+                f[1] += force_wall(pen_y, 0.1)
+            else:
+                f[0] += force_wall(pen_x)
+        # Wall on the left, touched from the top or from the right
+        right, top = self.wall[0] + self.wall[2], self.wall[1]
+        pen_x = right - (xm[0] - self.half_width)
+        pen_y = xm[1] + self.bottom - top
+        if pen_x > 0 and pen_y > 0:
+            if pen_x > pen_y:
+                f[1] += force_wall(pen_y, 0.1)
+            else:
+                f[0] -= force_wall(pen_x)
+        return f
+
+    def force(self, xh, xs, now):
+        # Local force for the operator position xh (operator screen pixels) with the submarine at xs, at time now (s).
+        # Same frame and units as the FORCE messages. Call it from a single thread, it keeps the velocity state
+        xm = self.to_submarine(xh, xs)
+        if self.prev_xm is not None and now > self.prev_t:
+            dt = now - self.prev_t
+            alpha = dt / (dt + self.tau)
+            v = self.v + alpha * ((xm - self.prev_xm) / self.window_scale / dt - self.v)
+            # Same scaling as Submarine.calc_forces
+            self.a = ((v - self.v) / self.window_scale) / dt
+            self.v = v
+        self.prev_xm = xm
+        self.prev_t = now
+
+        if not self.haptics:
+            self.last_force = np.zeros(2)
+            return self.last_force
+
+        # Same kernel as the submarine, without the fish and currents it cannot predict
+        f = water_forces(xm[None], self.v[None], self.a[None], self.mass, self.water_density, self.b_water,
+                         0, gravity=self.gravity, cross_sectional_area=self.cross_sectional_area,
+                         displaced_volume=self.displaced_volume, window_scale=self.window_scale)[0]
+        f[1] -= self.object_weight
+        f += self.contact_force(xm)
+        self.last_force = f
+        return f
+
+    def reset(self):
+        self.prev_xm = None
+        self.prev_t = None
+        self.v = np.zeros(2)
+        self.a = np.zeros(2)
+        self.object_weight = 0.0
+        self.last_force = np.zeros(2)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Real-time loop that runs tasks at independent rates from one thread, e.g. the network and physics step of the
+# submarine at 100 Hz or more and the rendering at 60 Hz, so a slow frame does not hold back the force feedback.
+# Times are measured with time.perf_counter, waits sleep until shortly before the next release and spin the rest.
+import time
+
+
+class Task:
+    # Callback run every 1/rate s. Its deadline is the next release: a run that ends later is an overrun.
+    #   skippable: the run is skipped while the tasks that are not skippable are late (the rendering)
+    def __init__(self, name, rate, callback, skippable=False):
+        self.name = name
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.callback = callback
+        self.skippable = skippable
+        self.next = None # perf_counter of the next release
+        self.runs = 0
+        self.overruns = 0 # runs that ended after their deadline
+        self.skipped = 0 # releases not run, skipped under load or dropped when too late
+        self.skips = 0 # releases skipped in a row
+        self.busy = 0.0 # time spent running (s)
+        self.worst = 0.0 # longest run (s)
+
+    def summary(self):
+        mean = self.busy / self.runs if self.runs else 0.0
+        return (f"{self.name}: {self.runs} runs at {self.rate:g} Hz, {self.overruns} overruns, {self.skipped} skipped, "
+                f"mean {mean * 1e3:.2f} ms, worst {self.worst * 1e3:.2f} ms")
+
+
+class Scheduler:
+    # The due tasks run in the order they were added, add first the ones that must not stutter.
+    #   max_late: a task more than max_late periods behind drops the missed releases instead of catching up
+    #   max_skips: a skippable task runs at least once every max_skips + 1 releases, even under load
+    #   spin: the last part of a wait (s) is a busy loop, sleep() wakes up too late for kHz rates
+    def __init__(self, max_late=5, max_skips=5, spin=0.0005, clock=time.perf_counter, sleep=time.sleep):
+        self.max_late = max_late
+        self.max_skips = max_skips
+        self.spin = spin
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.profiler = None # the waits are its "wait" stage (see profiler.py)
+
+    def add(self, name, rate, callback, skippable=False):
+        task = Task(name, rate, callback, skippable)
+        self.tasks.append(task)
+        return task
+
+    def late(self, now):
+        # Whether a task that is not skippable is due
+        return any(t.next is not None and t.next <= now for t in self.tasks if not t.skippable)
+
+    def run_once(self):
+        # Run the tasks that are due, then wait for the next release
+        now = self.clock()
+        for task in self.tasks:
+            if task.next is None:
+                task.next = now
+            if now < task.next:
+                continue
+            if task.skippable and task.skips < self.max_skips and self.late(now):
+                task.skipped += 1
+                task.skips += 1
+            else:
+                task.skips = 0
+                task.callback()
+                end = self.clock()
+                task.runs += 1
+                task.busy += end - now
+                task.worst = max(task.worst, end - now)
+                if end > task.next + task.period:
+                    task.overruns += 1
+                now = end
+            task.next += task.period
+            # Too far behind, e.g. after the window was dragged
+            behind = int((now - task.next) / task.period)
+            if behind > self.max_late:
+                task.skipped += behind
+                task.next += behind * task.period
+        self.wait()
+
+    def wait(self):
+        if self.profiler is not None:
+            with self.profiler.stage("wait"):
+                self.sleep_until_release()
+        else:
+            self.sleep_until_release()
+
+    def sleep_until_release(self):
+        release = min(t.next for t in self.tasks)
+        delay = release - self.clock()
+        if delay > self.spin:
+            self.sleep(delay - self.spin)
+        while self.clock() < release:
+            pass
+
+    def summary(self):
+        return "\n".join(task.summary() for task in self.tasks)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+class SimClock:
+    # Simulation time that advances in fixed steps of dt seconds. The time is kept as a step count, so the same
+    # inputs give the same run at any speed. Calling the clock returns the time in seconds.
+    # With realtime=True, due() accumulates the wall time since the last call and returns how many steps it
+    # covers (at most max_steps, the rest is dropped so a slow frame does not snowball). Otherwise every call
+    # is one step and the simulation runs as fast as the caller goes (see headless.py).
+    def __init__(self, dt=0.01, realtime=False, max_steps=5):
+        self.dt = dt
+        self.realtime = realtime
+        self.max_steps = max_steps
+        self.steps = 0
+        self.accumulator = 0.0 # wall time not simulated yet (s)
+        self.last = None # perf_counter of the last due() call
+        self.dropped = 0.0 # wall time skipped because more than max_steps were due (s)
+
+    def __call__(self):
+        return self.steps * self.dt
+
+    def advance(self):
+        self.steps += 1
+
+    def due(self):
+        # Number of steps to simulate now
+        if not self.realtime:
+            return 1
+        now = time.perf_counter()
+        if self.last is None:
+            self.last = now
+            return 1
+        self.accumulator += now - self.last
+        self.last = now
+        steps = int(self.accumulator / self.dt)
+        self.accumulator -= steps * self.dt
+        if steps > self.max_steps:
+            self.dropped += (steps - self.max_steps) * self.dt
+            steps = self.max_steps
+        return steps
+
+    def alpha(self):
+        # Fraction of a step accumulated but not simulated yet, to interpolate what is drawn
+        return self.accumulator / self.dt
@@ -2,12 +2,21 @@
 import sys
 import numpy as np
 import pygame
-import socket
 import random
 import time
 import math
 import traceback
 
+import protocol
+from network import Endpoint
+from scene_model import force_wall
+from forces import water_forces
+from colliders import ColliderWorld, Collider, TOP, LEFT, RIGHT
+from bodies import BodyWorld, Body
+from currents import CurrentField
+from sim_clock import SimClock
+from scheduler import Scheduler
+from estimator import MotionEstimator
 from Physics import Physics
 from Graphics_submarine import Graphics
 
@@ -25,28 +34,43 @@ class EndGame(Exception):
 
 
 class Submarine:
-    def __init__(self, render_haptics = True):
-        self.max_time = 1 * 60 # "T_minutes" * 60s = T_seconds 
+    def __init__(self, render_haptics = True, operator_port=40001, max_time=1 * 60, results_file="results.txt",
+                 net=None, headless=False, wait=True, clock=None, rng=None, num_fish=2,
+                 estimator=None, scheduler=None, render_rate=60):
+        self.max_time = max_time # "T_minutes" * 60s = T_seconds 
+        self.results_file = results_file # None to not save the results (e.g. benchmarks)
+        # The simulation advances in fixed steps of clock.dt, by default following the wall time.
+        # A clock that is not real time runs the game as fast as the caller goes (see headless.py)
+        if clock is None:
+            clock = SimClock(0.01, realtime=True)
+        self.clock = clock
+        # Random numbers of the currents (and of the fish after the third one), seed it to repeat a run
+        self.rng = rng if rng is not None else random.Random()
+        # Velocity and acceleration of the gripper (see estimator.py). A filtered one keeps the water forces
+        # smooth at high loop rates, e.g. MotionEstimator("savgol") with clock=SimClock(0.001, realtime=True)
+        self.estimator = estimator if estimator is not None else MotionEstimator()
         self.physics = Physics(hardware_version=0, connect_device=False) #setup physics class. Returns a boolean indicating if a device is connected
-        self.graphics = Graphics(False, num_fish=2, max_time=self.max_time) #setup class for drawing and graphics.
+        self.graphics = Graphics(False, num_fish=num_fish, max_time=self.max_time, headless=headless, clock=clock, rng=self.rng) #setup class for drawing and graphics.
         self.render_haptics = render_haptics
 
-        # Set up UDP sockets
-        self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.recv_sock.bind(("127.0.0.1", 40002))
-        self.recv_sock.setblocking(False)
-        
-        # Current
-        self.current_on = False
-        
-        # Fish
-        self.fish_left = pygame.transform.scale(pygame.image.load('imgs/fish_left.png'), (40, 20))
-        self.fish_right = pygame.transform.scale(pygame.image.load('imgs/fish_right.png'), (40, 20))
-        self.fish_dir = self.fish_right
-        self.fish_pos = np.array([200,400])
-        
-        self.fish_mode = 1
+        # With a scheduler (see scheduler.py) run() does the steps and the frames at their own rates: a step every
+        # clock.dt s and render_rate frames per second, skipped while the steps are late, so the forces keep
+        # flowing when drawing stutters. The clock has to count the steps only (realtime=False)
+        self.scheduler = scheduler
+        if scheduler is not None:
+            scheduler.add("step", 1.0 / self.clock.dt, self.step)
+            scheduler.add("frame", render_rate, self.render_frame, skippable=True)
+            scheduler.profiler = self.graphics.profiler # times its waits
+            self.graphics.FPS = 0 # the scheduler paces the frames, do not wait in render
+
+        # Set up UDP communication. The connection is considered lost after 1 s without messages from the operator
+        # operator_port can point to an impairment proxy instead of the operator (see impairment_proxy.py)
+        # A server running many sessions passes the link of the session instead (see submarine_server.py)
+        if net is None:
+            net = Endpoint(("127.0.0.1", 40002), ("127.0.0.1", operator_port), timeout=1.0)
+        self.net = net
+        self.profiler = self.graphics.profiler # stage times of the loop, 'p' toggles it (see profiler.py)
+        self.position_age = 0 # seconds since the last position message was sent by the operator
         
         self.xc = self.graphics.haptic.center
         self.collision_act = 0
@@ -57,15 +81,20 @@ class Submarine:
         self.object_mass = 0
         self.grabbed_object = ""
 
-        self.collision_platform = 0
-        self.collision_wall = 0
-        self.collision_anchor = 0
-        self.collision_chest = 0
-        self.collision_bottle = 0
+        # Colliders of the gripper. The platform and the wall hurt the submarine and push back the operator,
+        # the objects only stop the gripper. reach is how far below its position the gripper touches each one
+        g = self.graphics
+        self.colliders = ColliderWorld(half_width=20, top=24)
+        self.colliders.add(Collider("platform", g.platform, (TOP, LEFT), reach=25, damage=0.3, force=True))
+        self.colliders.add(Collider("wall", g.wall, (TOP, RIGHT), reach=25, damage=0.3, force=True))
+        self.object_colliders = [
+            self.colliders.add(Collider("anchor", g.anchor, reach=12, dynamic=True)),
+            self.colliders.add(Collider("chest", g.chest, reach=12, dynamic=True)),
+            self.colliders.add(Collider("bottle", g.bottle, reach=17, dynamic=True)),
+        ]
 
         # Haptic dim and mass 
         self.mass=0.5
-        self.prev_vh = 0
         self.haptic_width = 48
         self.haptic_height = 48
         self.haptic_length = 48
@@ -87,101 +116,71 @@ class Submarine:
             * (self.haptic_length / self.graphics.window_scale)
         ) 
 
+        # The objects are rigid bodies that sink and rest on the background, the grabbed one hangs from the gripper
+        # by a spring joint (see bodies.py). The drags make them sink at about 0.1 m/s
+        self.bodies = BodyWorld(g.window_scale, self.gravity, self.water_density)
+        self.bodies.add_static("wall", g.wall)
+        self.bodies.add_static("platform", g.platform)
+        self.bodies.add_static("table", g.table)
+        self.bodies.add_static("ground", g.ground)
+        self.objects = {
+            "anchor": self.bodies.add(Body("anchor", g.anchor, 1.0, density=7800, drag=85)),
+            "chest": self.bodies.add(Body("chest", g.chest, 0.5, density=1500, drag=31)),
+            "bottle": self.bodies.add(Body("bottle", g.bottle, 0.1, density=2500, drag=8)),
+        }
+        self.grab_offset = {"anchor": 12, "chest": 12, "bottle": 10} # how far the object hangs into the gripper
+
         # Perturbation parameters
         self.window_height = 600  
         self.num_sections = 5
         self.section_height = self.window_height // self.num_sections  
-        self.perturbations = []  # List to store active perturbations
+        self.currents = None # schedule of the currents of the game, made by start()
 
         # Fish collision constant
         self.k_fish = 50 
 
-        # Wait for at least one message from the master. Only continue once something is received.
+        # The operator keeps a replica of the scene model, send it the parameters every 10 frames and when they change
+        self.frame = 0
+        self.model_object_mass = None
+
+        # Positions of the last step, drawn by draw()
+        self.frame_state = None
+
+        if wait:
+            self.wait_for_operator()
+
+    def wait_for_operator(self):
+        # Wait for at least one position from the master. Only continue once something is received.
         print("Waiting for operator communication")
         i = 0
-        while True:
+        last_hello = 0
+        while self.net.latest(protocol.POSITION) is None:
             for event in pygame.event.get():  # Handle events to keep the window responsive
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     sys.exit(0)
-            try: 
-                self.send_sock.sendto(np.array([0,0,0], dtype=np.float32).tobytes(), ("127.0.0.1", 40001))
-                _ = self.recv_sock.recvfrom(1024)
-                # Set a timeout to allow closing the window automatically when the communication is broken
-                self.recv_sock.settimeout(1)
-                print("Connected")
-                break
-            except BlockingIOError:
-                self.graphics.show_loading_screen(i)
-                i += 1
-                pass
-        
+            # Let the operator know the submarine is ready, every 10 ms
+            if time.time() - last_hello > 0.01:
+                self.net.send(protocol.HELLO)
+                last_hello = time.time()
+            self.graphics.show_loading_screen(i)
+            i += 1
+        print("Connected")
+        self.start()
+
+    def start(self):
         # Init Metrics variables
         self.passed = False
         self.first = False
         self.damage = 0 # percentage
         self.path_length = 0 # pixels
-        self.init_time = time.time() # seconds
-
-    def generate_perturbation(self):
-        # Randomize the generation of the current's forces
-        section = random.randint(2, self.num_sections - 1)  
-        amplitude = random.uniform(3, 4)  
-        frequency = random.uniform(0.5, 2.0)  
-        start_time = time.time()  
-        duration = random.uniform(2.0, 3.0) 
-        direction = random.choice([-1, 1])  
-        return {
-            "section": section,
-            "amplitude": amplitude,
-            "frequency": frequency,
-            "start_time": start_time,
-            "duration": duration,
-            "direction": direction,  
-        }
-
-    def get_perturbation_force(self, xh, g):
-        # Calculate Current Force
-        perturbation_force = np.array([0.0, 0.0]) 
-        current_time = time.time()
-        new_perturbations = []
+        self.init_time = self.clock() # seconds
 
-        for pert in self.perturbations:
-            elapsed_time = current_time - pert["start_time"]
-            duration = pert["duration"]
+        # Randomize the currents of the whole game (and a bit more, the game ends on the step after max_time)
+        steps = int(math.ceil(self.max_time / self.clock.dt)) + 2
+        self.currents = CurrentField.generate(self.rng, steps, self.clock.dt, self.num_sections, self.window_height,
+                                              step0=self.clock.steps)
 
-            if elapsed_time < duration:
-                self.current_on = True
-                
-                y_min = pert["section"] * self.section_height
-                y_max = (pert["section"] + 1) * self.section_height
-
-                g.current_pos[1] = y_min
-                
-                if y_min <= xh[1] <= y_max:
-                    # Calculate force magnitude
-                    force_x = (
-                        pert["amplitude"]
-                        * math.sin(2 * math.pi * pert["frequency"] * elapsed_time)
-                        * pert["direction"]
-                    )
-
-                    # Smoothly reduce force to zero in the last 0.1 seconds
-                    if elapsed_time > (duration - 0.2):
-                        remaining_time = duration - elapsed_time
-                        scale_factor = max(0.0, remaining_time / 0.1)  # Linear ramp down
-                        force_x = 0
-
-                    perturbation_force[0] += force_x
-
-                new_perturbations.append(pert)
-            else:
-                self.current_on = False
-                g.current_pos[1] = 1200  # Reset position outside the screen
-
-        self.perturbations = new_perturbations  
-        return perturbation_force
-    
     def Grab_object(self, grab_object):
         g = self.graphics
         cursor=g.effort_cursor
@@ -189,168 +188,123 @@ class Submarine:
         if grab_object:
             # Detect when an object is grabbed for the first time and make sure only one can be picked up
             if not self.object_grabbed:
-                if (cursor.colliderect(g.anchor))  and (not cursor.colliderect(g.chest)) and ( not cursor.colliderect(g.bottle)) and "anchor" not in self.objects_in_target:
-                        g.anchor.topleft=(cursor.bottomleft[0],cursor.bottomleft[1]-12)
-                        self.object_grabbed = True
-                        self.grabbed_object = "anchor"
-                        self.object_mass = 1.0
-                elif (cursor.colliderect(g.chest))  and  (not cursor.colliderect(g.anchor)) and ( not cursor.colliderect(g.bottle)) and "chest" not in self.objects_in_target:
-                        g.chest.topleft=(cursor.bottomleft[0],cursor.bottomleft[1]-12)
-                        self.object_grabbed = True
-                        self.grabbed_object = "chest"
-                        self.object_mass = 0.5
-                elif (cursor.colliderect(g.bottle))  and  (not cursor.colliderect(g.chest)) and ( not cursor.colliderect(g.anchor)) and "bottle" not in self.objects_in_target:
-                        g.bottle.topleft=(cursor.bottomleft[0],cursor.bottomleft[1]-10)
-                        self.object_grabbed = True
-                        self.grabbed_object = "bottle"
-                        self.object_mass = 0.1
-                elif not ((cursor.colliderect(g.chest)) or (cursor.colliderect(g.anchor)) or (cursor.colliderect(g.anchor))):
+                touched = [name for name, body in self.objects.items() if cursor.colliderect(body.rect)]
+                if len(touched) == 1 and touched[0] not in self.objects_in_target:
+                    self.object_grabbed = True
+                    self.grabbed_object = touched[0]
+                    self.object_mass = self.objects[touched[0]].mass
+                    self.bodies.grab(self.objects[touched[0]], self.grab_target())
+                elif len(touched) < 2:
                     self.drop_object()
-            # If an object is alreadu grabbed update its position with the submarine gripper position
+            # If an object is already grabbed the joint follows the submarine gripper
             else:
-                if self.grabbed_object == "anchor":
-                    g.anchor.topleft = (cursor.bottomleft[0], cursor.bottomleft[1]-12)
-                    if g.anchor.colliderect(g.table):
-                        self.objects_in_target.append("anchor")
-                        self.drop_object()
-
-                elif self.grabbed_object == "chest":
-                    g.chest.topleft = (cursor.bottomleft[0], cursor.bottomleft[1]-12)
-                    if g.chest.colliderect(g.table):
-                        self.objects_in_target.append("chest")
-                        self.drop_object()
-
-                elif self.grabbed_object == "bottle":
-                    g.bottle.topleft = (cursor.bottomleft[0], cursor.bottomleft[1]-10)
-                    if g.bottle.colliderect(g.table):
-                        self.objects_in_target.append("bottle")
-                        self.drop_object()
-        # Reset if the space bar is pressed again
+                self.bodies.joint_target = self.grab_target()
+        # Reset if the space bar is pressed again, the object sinks
         else:
+            self.bodies.release()
             self.object_grabbed = False
             self.grabbed_object = ""
             self.object_mass = 0.0
 
+    def grab_target(self):
+        # Where the joint pulls the top left corner of the grabbed object
+        cursor = self.graphics.effort_cursor
+        return (cursor.bottomleft[0], cursor.bottomleft[1] - self.grab_offset[self.grabbed_object])
+
+    def move_objects(self):
+        # Objects that reach the table are in the target, the grabbed one is dropped there
+        self.bodies.step(self.clock.dt)
+        for name, body in self.objects.items():
+            if "table" in body.touching and name not in self.objects_in_target:
+                self.objects_in_target.append(name)
+                if name == self.grabbed_object:
+                    self.drop_object()
+
     # Helper fn to reduce code when dropping an object
     def drop_object(self):  
+        self.bodies.release()
         self.object_grabbed = False
         self.grabbed_object = ""
         self.object_mass = 0.0
         # Send message to the operator to reset the garb object flag
-        msg = np.array([2], dtype=np.float32)
-        self.send_sock.sendto(msg.tobytes(), ("127.0.0.1", 40001))
-        time.sleep(0.02) 
+        self.net.send(protocol.DROP)
 
     # Calculate all the forces involved in the haptic feedback
     def calc_forces(self, xh):
         g = self.graphics
-        dt = 0.01
-
-        if not hasattr(self, "prev_xh"):
-            self.prev_xh = xh.copy()
-        f_wave = np.array([0, 0], dtype=np.float32)
-        f_fish = np.array([0, 0], dtype=np.float32)
-        if random.random() < 0.1 and self.current_on == False:
-            self.perturbations.append(self.generate_perturbation())
-        f_wave = self.get_perturbation_force(xh,g)
-        depth = xh[1] / g.window_scale  # Depth in meters (y-axis increases downward)
-        f_hydrostatic = self.water_density * self.gravity * depth * self.cross_sectional_area
-        f_hydrostatic = np.array([0, f_hydrostatic])  # Apply only in the y-axis
-        f_perturbation = -(self.mass * self.gravity - self.water_density * self.displaced_volume * self.gravity)
-        f_perturbation = np.array([0, f_perturbation]) + f_hydrostatic + f_wave
-
-
-        fe = np.array([0, 0], dtype=np.float32)
-        fe += f_perturbation 
-        
-        haptic_rect = pygame.Rect(xh[0], xh[1], self.haptic_width, self.haptic_height)
-        # Forces from fish collision
-        if self.collision_act > 0:
-            penetration_depth = max(0, self.collision_act + 40 - haptic_rect.left)
-            f_fish[0] = (self.k_fish * penetration_depth/600)
-            fe += f_fish
-            # Reset collision state after applying force
-            self.collision_act = 0  # <-- Add this line
-
-        # Damping of the water
-        v_h = ((xh - self.prev_xh) / g.window_scale) / dt
+
+        # Current Force
+        f_wave = self.currents.force_at(xh, self.clock.steps)
+        g.current_pos[1] = self.currents.y_at(self.clock.steps)
+
+        # Velocity and acceleration of the gripper from the time of the step, in m/s. The forces were tuned with
+        # the acceleration scaled down by window_scale once more
+        v_h, a_h = self.estimator.update(self.clock(), xh)
+        v_h = v_h / g.window_scale
+        a_h = a_h / g.window_scale / g.window_scale
         self.b_water = 0.5
-        f_hydro = np.array(-self.b_water * v_h)
-        fe += f_hydro
-
-        # Inertia of the crane and object
-        a_h = ((v_h - self.prev_vh) / g.window_scale) / dt
-        f_inertia = self.mass* a_h
-        object_inertia = np.array([0.0,0.0], dtype=np.float32)
-        if (self.object_grabbed):
-            object_inertia += np.array([0.0, -9.8*(self.object_mass)])
-            object_inertia += self.object_mass * a_h
-        fe = fe + f_inertia + object_inertia
-        
-        self.prev_vh = v_h.copy()
-        return fe
 
-    def collision_object(self,xh, object, collision_specific_object, offset=0 ):
-        # Check if the limits of the handle respect to xh collision with the object
-        if (((xh[0]+ 20)>object.topleft[0]) and ((xh[0]- 20)<object.topright[0]) ) and ((xh[1]+12 + offset)>object.topleft[1]) and (collision_specific_object==0):
-                # Check if the collision is from top, left or right
-                if (((xh[0]+ 20)-object.topleft[0]) > ((xh[1]+12 - offset)-object.topleft[1])):
-                    # This condition only happens when xh is further away from left side than the top, meaning that when there was a collision was from the top or right side
-                    if ( -((xh[0]- 20)-object.topright[0]))  > ((xh[1]+12 + offset)-object.topleft[1]):
-                         # Collision from top
-                        collision_specific_object=1
-                    else:
-                        # Collision from right side
-                        collision_specific_object=3
-                else:
-                    # This condition only happens when xh is further away from top than the left side, meaning that when there was a collision was from the left side
-                    collision_specific_object=2  
-        # Check if the handle no longer collides with the object
-        elif ( ((xh[1]+12 + offset)<(object.topleft[1])) or ((xh[0] + 20)<(object.topleft[0])) or ((xh[0] - 20)>(object.topright[0]))) and (collision_specific_object!=0) :
-            # No collision (default)
-            collision_specific_object=0
-        # Adjust the handle accordingly
-        elif(collision_specific_object==1):
-            xh[1]=object.topleft[1]-12 - offset
-        elif(collision_specific_object==2):
-            xh[0]=object.topleft[0]-20
-        elif(collision_specific_object==3):
-            xh[0]=object.topright[0] + 20
-
-        return xh, collision_specific_object
+        # Water and fish forces, the kernel is shared with batched simulations (see forces.py)
+        fe = water_forces(xh[None], v_h[None], a_h[None], self.mass, self.water_density, self.b_water, 0,
+                          self.k_fish, self.collision_act, f_wave[None], self.gravity, self.cross_sectional_area,
+                          self.displaced_volume, g.window_scale)[0]
+        # Pull of the joint of the grabbed object, the y axis of the forces points up
+        fe += np.array([self.bodies.joint_force[0], -self.bodies.joint_force[1]])
+        # Reset collision state after applying force
+        self.collision_act = 0
+        return fe
 
     # determine the force depending on the side of the wall
     def force_wall(self,difference, k=0.2):
-        if (difference<50):
-            difference=50
-        elif (difference<60):
-            difference=100
-            k=0.3
-        elif (difference<70):
-            difference=150
-            k=0.4
-        elif(difference<90):
-            difference=500
-            k=0.8
-        elif(difference>=90):
-            difference=1000
-            k=1
-
-        return difference*k
+        # Shared with the operator scene model so both render the same contacts
+        return force_wall(difference, k)
+
+    def send_model(self):
+        # Parameters of the operator scene model (see scene_model.py)
+        g = self.graphics
+        # The joint of the grabbed object pulls the gripper down by its weight minus its buoyancy at rest
+        body = self.objects.get(self.grabbed_object)
+        object_weight = 0.0 if body is None else body.mass * self.gravity * (1 - self.water_density / body.density)
+        self.net.send(protocol.MODEL, self.render_haptics, self.mass, self.water_density, self.gravity,
+                      self.cross_sectional_area, self.displaced_volume, self.b_water, object_weight,
+                      *g.wall, *g.platform)
+        self.model_object_mass = self.object_mass
     
     def run(self):
+        # One frame: the simulation steps that are due on the clock, then the newest state is drawn.
+        # With a scheduler it runs the tasks that are due, the profiler frames then start with render_frame
+        if self.scheduler is not None:
+            self.scheduler.run_once()
+            return
+        self.profiler.frame()
+        self.events()
+        for _ in range(self.clock.due()):
+            self.step()
+        self.draw()
+
+    def events(self):
+        with self.profiler.stage("events"):
+            keyups = self.graphics.get_events()
+        for key in keyups:
+            if key == ord('p'): #Toggle the profiler overlay, the stage times are saved when the game closes
+                self.profiler.toggle()
+
+    def step(self):
+        # Advance the simulation by one fixed step of clock.dt seconds
         p = self.physics
         g = self.graphics
-        g.get_events()
         xs = np.array(g.submarine_pos)
         xh = np.array(g.haptic.center, dtype=np.float64) # Make sure fe is a numpy array
-        g.erase_screen()
         
-        # Receive and process messages
-        try:
-            # Receive position from the operator via UDP
-            recv_data, _ = self.recv_sock.recvfrom(64)
-            data = np.array(np.frombuffer(recv_data, dtype=np.float64))
+        with self.profiler.stage("network"):
+            # If nothing arrived for a while the connection with the operator has been lost
+            if self.net.lost:
+                raise EndGame("Connection lost", 1)
+
+            # Newest position from the operator, stale or reordered packets were already dropped by the network thread
+            msg = self.net.latest(protocol.POSITION)
+            self.position_age = msg.age()
+            data = np.array(msg.payload, dtype=np.float64)
             # scale and center position of gripper relative to the submarine position
             xm = data[:2]
             xm[0] = np.clip((xm[0] + ((g.submarine_pos[0] + 177) - (g.window_size[0]/2))), -100, g.window_size[0] + 100)
@@ -360,40 +314,44 @@ class Submarine:
             xs = np.array(data[2:4], dtype=int)
             # Grabb object
             grab_object=data[4]
-            
-        # If there is a timeout the connection with the operator has been lost
-        except socket.timeout:
-            raise EndGame("Connection lost", 1)
         
         # Grabbing Objects
-        self.Grab_object(grab_object)
+        with self.profiler.stage("objects"):
+            self.Grab_object(grab_object)
+            self.move_objects()
 
         # Calculate forces
-        fe = self.calc_forces(xh)
+        with self.profiler.stage("calc_forces"):
+            fe = self.calc_forces(xh)
         self.prev_xh = xh.copy()
 
+        # Update the scene model of the operator
+        if self.frame % 10 == 0 or self.object_mass != self.model_object_mass:
+            self.send_model()
+        self.frame += 1
+
         # Process the forces and position to render the environment
-        xh = g.sim_forces(xh,fe,xm,mouse_k=0.5,mouse_b=0.8) # Simulate forces with mouse haptics
+        with self.profiler.stage("sim_forces"):
+            xh = g.sim_forces(xh,fe,xm,mouse_k=0.5,mouse_b=0.8,dt=self.clock.dt) # Simulate forces with mouse haptics
         
         # Update fish
-        g.render_fish()
-
-        # Check collision with fish and increase damage
-        self.collision_act = 0  # Reset collision state every frame
-        for n, f in enumerate(g.fish):
-            if f == 1:              
-                # Check distance from fish to each line
-                if (g.effort_cursor.colliderect(g.fish_rect[n]) or 
-                    (xh[1] >= g.fish_pos[n][1] and (np.abs(g.fish_pos[n][0] - xh[0])<50))):
-                    self.collision_act = g.fish_pos[n][0]  # Set collision state
-                    self.damage += 0.1
+        with self.profiler.stage("fish"):
+            g.update_fish(self.clock.dt)
+
+            # Check collision with fish and increase damage
+            self.collision_act = 0  # Reset collision state every frame
+            hits = np.flatnonzero(g.fish.hits(g.effort_cursor, xh))
+            if len(hits):
+                self.collision_act = g.fish.pos[hits[-1], 0]  # Set collision state
+                self.damage += 0.1 * len(hits)
                 
         # Ensure haptic device stays within the window bounds
         xh[0] = np.clip(xh[0], 0, g.window_size[0] - self.haptic_width)
         xh[1] = np.clip(xh[1], 0, g.window_size[1] - self.haptic_height)
         
-        pos_phys = g.inv_convert_pos(xh)
-        pA0,pB0,pA,pB,pE = p.derive_device_pos(pos_phys) # Derive the pantograph joint positions given some endpoint position
+        with self.profiler.stage("derive_device_pos"):
+            pos_phys = g.inv_convert_pos(xh)
+            pA0,pB0,pA,pB,pE = p.derive_device_pos(pos_phys) # Derive the pantograph joint positions given some endpoint position
 
         # Scale the physics results for submarine size
         pB0 = pA0
@@ -403,63 +361,34 @@ class Submarine:
 
         pA0, pB0, pA, pB, xh = g.convert_pos(pA0, pB0, pA, pB, pE)
 
-        # Check collision with platform on the right and limit the handle position accordingly
-        if ((xh[0]+ 20)>g.platform.topleft[0]) and ((xh[1]+25)>g.platform.topleft[1]) and (self.collision_platform==0):
-            if ((xh[0]+ 20)-g.platform.topleft[0]) > ((xh[1]+25)-g.platform.topleft[1]):
-                self.collision_platform=1
-            else:
-                self.collision_platform=2    
-        elif (((xh[1]+25)<(g.platform.topleft[1])) or (xh[0] + 20)<(g.platform.topleft[0])) and (self.collision_platform!=0):
-            self.collision_platform=0
-        elif(self.collision_platform==1):
-            xh[1]=g.platform.topleft[1]-25
-            self.damage += 0.3
-            difference=xm[1] - xh[1]  
-            wall_force = self.force_wall(difference,0.1) 
-            fe+=np.array([0,wall_force])
-        elif(self.collision_platform==2):
-            xh[0]=g.platform.topleft[0]-20
-            self.damage += 0.3 
-            difference=xm[0]-xh[0]
-            wall_force = self.force_wall(difference) 
-            fe+=np.array([wall_force,0])
-            
-        #Check collision with wall on the left and limit the handle position accordingly
-        if ((xh[0] - 20)<g.wall.topright[0]) and ((xh[1]+25)>g.wall.topright[1]) and self.collision_wall==0:
-            if ( - ((xh[0] - 20)-g.wall.topright[0]) > ((xh[1]+25)-g.wall.topright[1])):
-                self.collision_wall=1
-            else:
-                self.collision_wall=2        
-        elif (((xh[1]+25)<(g.wall.topright[1])) or (xh[0] - 20)>(g.wall.topright[0])) and (self.collision_wall!=0):
-            self.collision_wall=0
-        elif(self.collision_wall==1):
-            xh[1]=g.wall.topright[1]-25
-            self.damage += 0.3 
-            difference=xm[1] - xh[1]  
-            wall_force = self.force_wall(difference,0.1) 
-            fe+=np.array([0,wall_force])
-        elif(self.collision_wall==2):
-            xh[0]=g.wall.topright[0] + 20
-            self.damage += 0.3 
-            difference=xh[0] - xm[0]
-            wall_force = self.force_wall(difference) 
-            fe+=np.array([-wall_force,0])
-
-        # Check collision with the different objects only while an object has not been grabbed and limit the handle position accordingly
-        if (self.object_grabbed==False):
-            xh, self.collision_anchor= self.collision_object(xh,g.anchor, self.collision_anchor)
-            xh, self.collision_chest= self.collision_object(xh,g.chest, self.collision_chest)
-            xh, self.collision_bottle= self.collision_object(xh,g.bottle, self.collision_bottle,5)
+        # Contacts with the background and the objects, the objects are only solid while nothing is grabbed
+        for c in self.object_colliders:
+            c.active = not self.object_grabbed
+        with self.profiler.stage("colliders"):
+            xh, contacts = self.colliders.resolve(xh)
+        for contact in contacts:
+            c = contact.collider
+            self.damage += c.damage
+            # Push back with a force that grows with how far the operator went into the collider
+            if c.force:
+                if contact.side == TOP:
+                    fe += np.array([0, self.force_wall(xm[1] - xh[1], 0.1)])
+                elif contact.side == LEFT:
+                    fe += np.array([self.force_wall(xm[0] - xh[0]), 0])
+                else:
+                    fe += np.array([-self.force_wall(xh[0] - xm[0]), 0])
            
-        # Send force the first 0 is the type of the message informing the operator that it is a force message
-        if self.render_haptics:
-            msg = np.array([0, *fe], dtype=np.float32)
-        else: 
-            msg = np.array([0, 0, 0], dtype=np.float32)
-        self.send_sock.sendto(msg.tobytes(), ("127.0.0.1", 40001))
-
-        # Update Visualization
-        g.render(pA0, pB0, pA, pB, xh, fe, xm, xs, self.init_time, self.damage)  # Render environment
+        # Send force feedback to the operator, echoing the position it was computed from for the latency statistics
+        with self.profiler.stage("send"):
+            hold = time.time() - msg.recv_time
+            if self.render_haptics:
+                self.net.send(protocol.FORCE, *fe, msg.seq, msg.stamp, hold)
+            else: 
+                self.net.send(protocol.FORCE, 0, 0, msg.seq, msg.stamp, hold)
+
+        # Update the scene, draw() renders it
+        g.update(xh, xs)
+        self.frame_state = (pA0, pB0, pA, pB, xh, fe, xm, xs)
 
         # Skip First iteration as the distance should be 0
         if not self.first:
@@ -467,9 +396,10 @@ class Submarine:
         # Update the path length with the distance traveled since the previous fame
         else:
             self.path_length += np.linalg.norm(self.prev_xh - np.ceil(xh))
+        self.clock.advance()
 
         # Check if game is over FAIL
-        if (time.time() - self.init_time >= self.max_time or self.damage >= 100):
+        if (self.clock() - self.init_time >= self.max_time or self.damage >= 100):
             self.passed = False
             raise EndGame("Game Finished", 0)
         # Check is the game is over WIN
@@ -477,42 +407,62 @@ class Submarine:
             self.passed = True
             raise EndGame("Game Finished", 0)
 
-    def close(self, show_exit_screen):
-        play_again = False
-        if show_exit_screen: 
-            # Get metrics 
-            final_time = time.time() - self.init_time
-            results = np.array([1, self.passed, final_time, self.path_length, self.damage], dtype=np.float32)
-            # Send metrics the first element is 1, the type of the message informing the operator that it is a metrics message
-            self.send_sock.sendto(results.tobytes(), ("127.0.0.1", 40001))
-            # print metrics to make sure they were received correctly
-            print(f"Passed: {self.passed}, Time: {final_time:.2f}, Path_length: {self.path_length:.2f}, damage: {self.damage:.0f}")
-            # Save results to file 
-            with open("results.txt", "a") as file:
-                file.write(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}, Passed: {self.passed}, Time: {final_time:.2f}, Path_length: {self.path_length:.2f}, Damage: {self.damage:.0f} \n")
-            
-            # Wait for message from the operator to play again or not
-            start_time = time.time()
-            while True:
-                try:
-                    self.recv_sock.settimeout(2)
-                    recv_data, _ = self.recv_sock.recvfrom(1024)
-                    data = np.array(np.frombuffer(recv_data, dtype=int))
-                    print(data)
-                    if(data[0] == 1500):
-                        play_again = bool(data[1])
-                        break
-                except :
-                    # add a 1 min time-out to prevent an infinite loop if the operator is no longer active.
-                    if (time.time() - start_time > 60):
-                        break
-                    continue
-
+    def render_frame(self):
+        # Window events and drawing, run by the scheduler. A profiler frame goes from one drawing to the next and
+        # includes the steps run in between and the waits of the scheduler
+        self.profiler.frame()
+        self.events()
+        self.draw()
+
+    def draw(self):
+        # Render the state of the last step
+        if self.frame_state is None:
+            return
+        with self.profiler.stage("render"):
+            self.graphics.erase_screen()
+            self.graphics.render(*self.frame_state, self.init_time, self.damage)  # Render environment
+
+    def send_results(self, prefix=""):
+        # Get metrics 
+        final_time = self.clock() - self.init_time
+        # Send metrics, this also informs the operator that the game is over
+        self.net.send(protocol.METRICS, self.passed, final_time, self.path_length, self.damage)
+        # print metrics to make sure they were received correctly
+        print(f"{prefix}Passed: {self.passed}, Time: {final_time:.2f}, Path_length: {self.path_length:.2f}, damage: {self.damage:.0f}")
+        # Save results to file 
+        if self.results_file is not None:
+            with open(self.results_file, "a") as file:
+                file.write(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}, {prefix}Passed: {self.passed}, Time: {final_time:.2f}, Path_length: {self.path_length:.2f}, Damage: {self.damage:.0f} \n")
+
+    def wait_play_again(self, timeout=60):
+        # Wait for message from the operator to play again or not
+        start_time = time.time()
+        while True:
+            msg = self.net.take(protocol.PLAY_AGAIN)
+            if msg is not None:
+                return msg.payload[0]
+            # add a time-out to prevent an infinite loop if the operator is no longer active.
+            if (time.time() - start_time > timeout):
+                return False
+            time.sleep(0.01)
+
+    def release(self):
         # Close used resources
         self.physics.close()
         self.graphics.close()
-        self.send_sock.close()
-        self.recv_sock.close()
+        self.net.close()
+
+    def close(self, show_exit_screen):
+        play_again = False
+        if self.scheduler is not None:
+            print(self.scheduler.summary())
+        filename = self.profiler.save(prefix="profile_submarine")
+        if filename is not None:
+            print(f"Stage times saved to {filename}")
+        if show_exit_screen: 
+            self.send_results()
+            play_again = self.wait_play_again()
+        self.release()
         return play_again
 
 if __name__=="__main__":
@@ -528,6 +478,11 @@ if __name__=="__main__":
     except:
         # Default to haptics enabled
         render_haptics = True
+    try:
+        operator_port = int(sys.argv[3])
+    except:
+        # Default operator port, use the proxy port to run through impairment_proxy.py
+        operator_port = 40001
         
     play_again = True
     # Add name and haptics mode to the results file
@@ -535,7 +490,8 @@ if __name__=="__main__":
             file.write(f"Participant Name: {name}, Haptic: {render_haptics}\n")
         
     while play_again:
-        submarine = Submarine(render_haptics)
+        # Steps every 10 ms and 60 frames per second, each at its own rate
+        submarine = Submarine(render_haptics, operator_port, clock=SimClock(0.01), scheduler=Scheduler())
         try:
             while True:
                 submarine.run()
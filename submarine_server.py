@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Submarine server: runs the submarine of many operators in one process, over a single UDP socket.
+# Every operator is a session, identified by the session ID in the header of its datagrams, with its own
+# Submarine (damage, objects, currents, fish...). Sessions are headless except the one picked with --render,
+# pygame only has one window per process.
+#
+#   python submarine_server.py --port 40002 --max-sessions 16 --render first
+#   python remote_operator.py 40002 false 0      (local port 0 so several operators can run on the same machine)
+import argparse
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+import pygame
+
+import protocol
+from network import Server
+from latency import RingBuffer
+from submarine import Submarine, EndGame
+from sim_clock import SimClock
+
+WAITING = 0  # waiting for the first position of the operator
+RUNNING = 1  # game in progress
+FINISHED = 2 # metrics sent, waiting for the operator to play again or not
+
+
+class Session:
+    # One operator of the server and the Submarine it is playing with
+    def __init__(self, session, link, render, render_haptics, max_time, results_file, dt=0.01):
+        self.session = session
+        self.link = link
+        self.render = render
+        self.render_haptics = render_haptics
+        self.max_time = max_time
+        self.results_file = results_file
+        self.dt = dt
+        self.step_time = RingBuffer(1000) # seconds spent in each step of this session
+        self.games = 0
+        self.new_game()
+
+    def new_game(self):
+        # One simulation step per tick, an overloaded server slows the games down instead of running them in bursts
+        self.submarine = Submarine(self.render_haptics, max_time=self.max_time, results_file=self.results_file,
+                                   net=self.link, headless=not self.render, wait=False, clock=SimClock(self.dt))
+        # The server keeps the loop rate, the window must not slow it down
+        self.submarine.graphics.FPS = 0
+        self.state = WAITING
+        self.state_time = time.time()
+        self.last_hello = 0
+        self.games += 1
+
+    def step(self):
+        # Advance the session by one frame. Returns False once the session is over
+        start = time.perf_counter()
+        try:
+            return self._step()
+        finally:
+            self.step_time.append(time.perf_counter() - start)
+
+    def _step(self):
+        sub = self.submarine
+        if self.state == WAITING:
+            if self.link.lost:
+                return False
+            if self.link.latest(protocol.POSITION) is None:
+                # Let the operator know the submarine is ready, every 10 ms
+                if time.time() - self.last_hello > 0.01:
+                    self.link.send(protocol.HELLO)
+                    self.last_hello = time.time()
+                if self.render:
+                    sub.graphics.get_events()
+                    sub.graphics.show_loading_screen()
+                return True
+            print(f"[session {self.session}] Connected")
+            sub.start()
+            self.state = RUNNING
+
+        if self.state == RUNNING:
+            try:
+                sub.run()
+            except EndGame as e:
+                print(f"[session {self.session}] Game stopped with exception: {e}")
+                if e.error_code != 0:
+                    return False
+                sub.send_results(f"Session: {self.session}, ")
+                self.state = FINISHED
+                self.state_time = time.time()
+            return True
+
+        # FINISHED: same as Submarine.wait_play_again without blocking the other sessions
+        msg = self.link.take(protocol.PLAY_AGAIN)
+        if msg is not None:
+            if not msg.payload[0]:
+                return False
+            sub.release()
+            self.link.reset()
+            self.new_game()
+        elif time.time() - self.state_time > 60:
+            return False
+        return True
+
+    def close(self):
+        self.submarine.release()
+
+
+class SubmarineServer:
+    # Steps every session once per tick at `rate` Hz. A step is a full Submarine frame, so the CPU used by a session
+    # is bounded by one frame per tick: a session is never stepped twice to catch up. New sessions are refused when
+    # the server is at max_sessions, or when the steps already take more than max_load of the tick.
+    def __init__(self, port=40002, max_sessions=16, render=None, rate=100, max_time=1 * 60,
+                 results_file="results.txt", render_haptics=True, max_load=0.8):
+        self.server = Server(("127.0.0.1", port), timeout=1.0, max_sessions=max_sessions)
+        self.render = render # session ID to show in the window, "first" for the first session, None for no window
+        self.period = 1.0 / rate
+        self.max_time = max_time
+        self.results_file = results_file
+        self.render_haptics = render_haptics
+        self.max_load = max_load
+        self.sessions = {}
+        self.rendered = None # session ID of the session with the window
+
+        # Statistics of the tick
+        self.load = RingBuffer(100) # fraction of the period spent stepping the sessions
+        self.overruns = 0 # ticks that took longer than one period
+        self.refused = set()
+
+    def accept(self):
+        # Start the sessions created by the network thread since the last tick
+        while self.server.new_sessions:
+            session = self.server.new_sessions.pop(0)
+            link = self.server.sessions.get(session)
+            if link is None or session in self.sessions:
+                continue
+            if len(self.load.values()) > 0 and np.mean(self.load.values()) > self.max_load:
+                if session not in self.refused:
+                    print(f"[server] Refused session {session}: load {np.mean(self.load.values())*100:.0f}%")
+                    self.refused.add(session)
+                self.server.remove(session)
+                continue
+            render = self.rendered is None and (self.render == "first" or self.render == session)
+            try:
+                self.sessions[session] = Session(session, link, render, self.render_haptics, self.max_time, self.results_file,
+                                                 self.period)
+            except Exception:
+                print(f"[server] Could not start session {session}:")
+                traceback.print_exc()
+                self.server.remove(session)
+                continue
+            if render:
+                self.rendered = session
+            self.refused.discard(session)
+            print(f"[server] Session {session} started ({len(self.sessions)} active){' with window' if render else ''}")
+
+    def end(self, session):
+        self.sessions.pop(session).close()
+        self.server.remove(session)
+        if self.rendered == session:
+            self.rendered = None
+        print(f"[server] Session {session} ended ({len(self.sessions)} active)")
+
+    def tick(self):
+        # pygame turns SIGINT/SIGTERM into QUIT events, without a window nobody else reads them
+        if self.rendered is None and pygame.display.get_init() and pygame.event.peek(pygame.QUIT):
+            sys.exit(0)
+        self.accept()
+        start = time.perf_counter()
+        for session, s in list(self.sessions.items()):
+            try:
+                alive = s.step()
+            except Exception:
+                print(f"[session {session}] Unhandled exception occurred:")
+                traceback.print_exc()
+                alive = False
+            if not alive:
+                self.end(session)
+        self.load.append((time.perf_counter() - start) / self.period)
+
+    def report(self):
+        load = self.load.values()
+        line = f"[server] {len(self.sessions)} sessions, load {np.mean(load)*100 if len(load) else 0:.0f}%, overruns {self.overruns}"
+        for session, s in self.sessions.items():
+            p = s.step_time.percentiles((50, 99)) * 1e3
+            line += f" | {session}: {p[0]:.2f}/{p[1]:.2f} ms"
+        print(line)
+
+    def run(self, report=5.0):
+        next_time = time.perf_counter()
+        last_report = next_time
+        while True:
+            self.tick()
+            next_time += self.period
+            now = time.perf_counter()
+            if now < next_time:
+                time.sleep(next_time - now)
+            else:
+                self.overruns += 1
+                next_time = now
+            if report and now - last_report >= report:
+                self.report()
+                last_report = now
+
+    def close(self):
+        for session in list(self.sessions):
+            self.end(session)
+        self.server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Submarine server for many operators at the same time")
+    parser.add_argument("--port", type=int, default=40002)
+    parser.add_argument("--max-sessions", type=int, default=16)
+    parser.add_argument("--render", default=None, help="session ID to show in the window, or 'first'")
+    parser.add_argument("--rate", type=float, default=100.0, help="frame rate of every session in Hz")
+    parser.add_argument("--max-time", type=float, default=60.0, help="length of a game in s")
+    parser.add_argument("--max-load", type=float, default=0.8, help="refuse sessions above this fraction of the frame time")
+    parser.add_argument("--no-haptics", action="store_true", help="sessions send zero forces")
+    parser.add_argument("--results", default="results.txt", help="results file, 'none' to not save them")
+    args = parser.parse_args()
+
+    render = args.render
+    if render is not None and render != "first":
+        render = int(render)
+    if render is None:
+        # Headless sessions still use pygame for rects and images, no display is needed
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    results_file = None if args.results.lower() == "none" else args.results
+
+    server = SubmarineServer(args.port, args.max_sessions, render, args.rate, args.max_time, results_file,
+                             not args.no_haptics, args.max_load)
+    print(f"Submarine server listening on port {args.port}")
+    try:
+        server.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception:
+        print("Unhandled exception occurred:")
+        traceback.print_exc()
+    finally:
+        server.close()
+        sys.exit(0)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import pygame
+
+
+class TextCache:
+    # Fonts and rendered texts of the HUD. Opening a font parses the TTF file, so each size is loaded once, and a
+    # text is only rendered again when its string (or color) changes: static labels are rendered once and values
+    # like the timer once per change. Texts that change every frame would only push the others out, render them
+    # with font(size).render instead. The surfaces are shared, blit them but do not draw on them.
+    #   size: number of rendered texts kept, the least recently used is dropped when full
+    def __init__(self, name='freesansbold.ttf', size=64):
+        self.name = name
+        self.size = size
+        self.fonts = {}
+        self.texts = {}
+
+    def font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font = self.fonts[size] = pygame.font.Font(self.name, size)
+        return font
+
+    def render(self, text, size, color, background=None):
+        key = (text, size, color, background)
+        surface = self.texts.pop(key, None)
+        if surface is None:
+            if len(self.texts) >= self.size:
+                del self.texts[next(iter(self.texts))]
+            surface = self.font(size).render(text, True, color, background)
+        # Most recently used last
+        self.texts[key] = surface
+        return surface
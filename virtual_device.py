@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+
+
+class VirtualDevice:
+    # Haptic endpoint simulated when no device is connected: a mass pulled towards the mouse by a spring, slowed
+    # down by a damper and pushed by the rendered force. Integrated with semi-implicit Euler in `substeps` steps
+    # per frame, the position is kept in float pixels so slow motions are not lost to rounding.
+    #   k, b: mouse spring and damper of Graphics.sim_forces, tuned for frames of reference_dt s
+    #   (k/b is the fraction of the distance to the mouse covered in one such frame when the mass is 0)
+    #   mass: inertia of the endpoint, the default gives a velocity time constant of 5 ms with b=0.8
+    #   window_scale: pixels per meter, forces (N) are scaled by window_scale/1e3 as before
+    def __init__(self, k=0.5, b=0.8, mass=4e-5, substeps=10, reference_dt=0.01, window_scale=3000, max_dt=0.05):
+        self.k = k
+        self.b = b
+        self.mass = mass
+        self.substeps = substeps
+        self.reference_dt = reference_dt
+        self.scale = window_scale / 1e3
+        self.max_dt = max_dt # longer frames (e.g. a window drag) are simulated as max_dt
+        self.pos = None
+        self.vel = np.zeros(2) # pixels per second
+        self.last = None # perf_counter of the last step without a dt
+
+    def reset(self, pos):
+        self.pos = np.array(pos, dtype=np.float64)
+        self.vel = np.zeros(2)
+
+    def sync(self, pos):
+        # Follow the position of the caller when something else moved the endpoint (window border, walls...).
+        # Differences up to a pixel are the rounding of the drawn position
+        pos = np.asarray(pos, dtype=np.float64)
+        if self.pos is None:
+            self.reset(pos)
+            return
+        moved = np.abs(pos - self.pos) > 1
+        self.pos[moved] = pos[moved]
+        self.vel[moved] = 0
+
+    def step(self, pos, f, pM, dt=None):
+        # Advance one frame of dt s (measured from the last call if None) with force f and the mouse at pM.
+        # Returns the new float position
+        if dt is None:
+            now = time.perf_counter()
+            dt = self.reference_dt if self.last is None else now - self.last
+            self.last = now
+        dt = min(dt, self.max_dt)
+        self.sync(pos)
+        # Python floats, the loop is too short for NumPy to pay off
+        mx, my = float(pM[0]), float(pM[1])
+        fx, fy = float(f[0]) * self.scale, float(f[1]) * self.scale
+        x, y = self.pos.tolist()
+        vx, vy = self.vel.tolist()
+        k = self.k
+        damping = self.b * self.reference_dt
+        h = dt / self.substeps
+        hm = h / self.mass
+        for _ in range(self.substeps):
+            vx += hm * (k * (mx - x) - damping * vx - fx)
+            vy += hm * (k * (my - y) - damping * vy - fy)
+            x += h * vx
+            y += h * vy
+        self.pos = np.array([x, y])
+        self.vel = np.array([vx, vy])
+        return self.pos.copy()